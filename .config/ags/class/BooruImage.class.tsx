@@ -13,6 +13,10 @@ import { booruApis } from "../constants/api.constants";
 import GLib from "gi://GLib";
 import { connectPopoverEvents } from "../utils/window";
 import { setProfileAvatarFromPath } from "../utils/profile-avatar";
+import {
+  booruRequest,
+  BooruServiceUnavailable,
+} from "../services/booru.service";
 
 import Hyprland from "gi://AstalHyprland";
 import { Gdk, Gtk } from "ags/gtk4";
@@ -23,7 +27,10 @@ const booruScriptPath = `${GLib.get_home_dir()}/.config/ags/scripts/booru.py`;
 
 type BookmarkActionResponse = {
   bookmarked?: boolean;
+  changed?: boolean;
+  bookmark?: Partial<BooruImage>;
   bookmarks?: Array<Partial<BooruImage>>;
+  duplicate_of?: Partial<BooruImage>;
 };
 
 const parseBookmarkActionResponse = (raw: string): BookmarkActionResponse => {
@@ -53,6 +60,12 @@ const parseBookmarkActionResponse = (raw: string): BookmarkActionResponse => {
   return parsed as BookmarkActionResponse;
 };
 
+/**
+ * Bookmarked "id:api" keys as last reported by booru.py; booru.py's store is
+ * the source of truth, this is only its membership view for the UI.
+ */
+export const [bookmarkKeys, setBookmarkKeys] = createState<string[]>([]);
+
 /**
  * Pause any playing Gtk.Video in the subtree without destroying the pipeline.
  * Safe to call on popover close when the widget tree will be reused on reopen.
@@ -123,6 +136,7 @@ export class BooruImage {
   extension?: string;
   url?: string;
   preview?: string;
+  md5?: string;
 
   // Runtime state (not serialized)
   private _isDownloaded?: boolean;
@@ -133,6 +147,7 @@ export class BooruImage {
   private _setLoadingState!: Setter<"loading" | "error" | "success" | "idle">;
   private static _bookmarkKeys = new Set<string>();
   private static _bookmarkCacheHydrated = false;
+  private static _bookmarkHydration?: Promise<void>;
   private static _pinKeys = new Set<string>();
   private static _pinCacheHydrated = false;
 
@@ -153,6 +168,7 @@ export class BooruImage {
     this.extension = data.extension;
     this.url = data.url;
     this.preview = data.preview;
+    this.md5 = data.md5;
     // createState must be called inside a reactive root — wrap in createRoot
     // to give it a proper owner so AGS never crashes with "out of tracking context".
     createRoot(() => {
@@ -278,26 +294,13 @@ export class BooruImage {
    * Check if media is bookmarked
    */
   isBookmarked(): boolean {
-    const key = this.getBookmarkKey();
     if (BooruImage._bookmarkCacheHydrated) {
-      this._isBookmarked = BooruImage._bookmarkKeys.has(key);
+      this._isBookmarked = BooruImage._bookmarkKeys.has(this.getBookmarkKey());
       return this._isBookmarked;
     }
 
-    if (this._isBookmarked !== undefined) return this._isBookmarked;
-
-    const currentBookmarks = globalSettings.peek().booru.bookmarks;
-    // .some() always returns boolean, so the assignment is always boolean.
-    const bookmarked = currentBookmarks.some(
-      (img: any) => img.id === this.id && img.api?.value === this.api.value,
-    );
-    this._isBookmarked = bookmarked;
-
-    if (bookmarked) {
-      BooruImage._bookmarkKeys.add(key);
-    }
-
-    return bookmarked;
+    void BooruImage.hydrateBookmarkCache();
+    return this._isBookmarked ?? false;
   }
 
   private getBookmarkKey(): string {
@@ -308,19 +311,45 @@ export class BooruImage {
     return `${this.id}:${this.api.value}`;
   }
 
-  static syncBookmarkCache(bookmarks: Array<Partial<BooruImage>>): void {
-    const next = new Set<string>();
+  static syncBookmarkCache(keys: Iterable<string>): void {
+    BooruImage._bookmarkKeys = new Set(keys);
+    BooruImage._bookmarkCacheHydrated = true;
+    setBookmarkKeys([...BooruImage._bookmarkKeys]);
+  }
 
-    for (const bookmark of bookmarks) {
-      const bookmarkId = bookmark?.id;
-      const apiValue = bookmark?.api?.value;
-      if (typeof bookmarkId === "number" && typeof apiValue === "string") {
-        next.add(`${bookmarkId}:${apiValue}`);
-      }
-    }
+  /**
+   * Load bookmark membership from booru.py (keys only, not the full list).
+   * Concurrent callers share one request; pass force to re-read the store.
+   */
+  static hydrateBookmarkCache(force = false): Promise<void> {
+    if (BooruImage._bookmarkHydration) return BooruImage._bookmarkHydration;
+    if (BooruImage._bookmarkCacheHydrated && !force) return Promise.resolve();
+
+    BooruImage._bookmarkHydration = execAsync([
+      "python",
+      booruScriptPath,
+      "--action",
+      "bookmark-keys",
+    ])
+      .then((response) => {
+        const parsed = JSON.parse(response) as {
+          keys?: string[];
+          error?: boolean;
+          message?: string;
+        };
+        if (parsed.error === true || !Array.isArray(parsed.keys)) {
+          throw new Error(parsed.message?.trim() || "Invalid bookmark keys");
+        }
+        BooruImage.syncBookmarkCache(parsed.keys);
+      })
+      .catch((err) => {
+        console.error("Failed to load bookmark keys:", err);
+      })
+      .finally(() => {
+        BooruImage._bookmarkHydration = undefined;
+      });
 
-    BooruImage._bookmarkKeys = next;
-    BooruImage._bookmarkCacheHydrated = true;
+    return BooruImage._bookmarkHydration;
   }
 
   static syncPinCache(pins: Array<Partial<BooruImage>>): void {
@@ -379,23 +408,28 @@ export class BooruImage {
         return;
       }
 
-      const curlArgs = ["curl", "-f", "-o", imagePath];
-
-      if (this.api.url) {
-        curlArgs.splice(
-          1,
-          0,
-          "-L",
-          "-H",
-          `Referer: ${this.api.url}`,
-          "-A",
-          "AGSBooruViewer/1.0 (ArchLinux; Hyprland)",
-        );
-      }
-
-      curlArgs.push(imageUrl);
-
-      await execAsync(curlArgs);
+      // One size-capped copy per file content in booru.py's media store,
+      // imagePath links to it. The service skips a Python start per image.
+      const request = {
+        download: imageUrl,
+        output: imagePath,
+        api: this.api.value,
+        ...(this.md5 ? { md5: this.md5 } : {}),
+      };
+      await booruRequest(request).catch((err) => {
+        if (!(err instanceof BooruServiceUnavailable)) throw err;
+        return execAsync([
+          "python",
+          booruScriptPath,
+          "--download",
+          imageUrl,
+          "--output",
+          imagePath,
+          "--api",
+          this.api.value,
+          ...(this.md5 ? ["--md5", this.md5] : []),
+        ]);
+      });
 
       this._isDownloaded = true;
       this._setLoadingState("success");
@@ -626,38 +660,27 @@ export class BooruImage {
       ]);
 
       const parsed = parseBookmarkActionResponse(response);
+
+      // Same content already bookmarked from another booru: nothing changed
+      const duplicate = parsed.duplicate_of;
+      if (duplicate) {
+        notify({
+          summary: "Already bookmarked",
+          body: `Same image as ${duplicate.api?.name ?? duplicate.api?.value} #${duplicate.id}`,
+        });
+        return false;
+      }
+
       const isBookmarked = parsed.bookmarked === true;
 
-      if (Array.isArray(parsed.bookmarks)) {
-        BooruImage.syncBookmarkCache(parsed.bookmarks);
-        setGlobalSetting("booru.bookmarks", parsed.bookmarks);
+      // Apply the delta; the store stays in booru.py, not in settings.json
+      const keys = new Set(BooruImage._bookmarkKeys);
+      if (isBookmarked) {
+        keys.add(this.getBookmarkKey());
       } else {
-        BooruImage._bookmarkCacheHydrated = true;
-        if (isBookmarked) {
-          BooruImage._bookmarkKeys.add(this.getBookmarkKey());
-          const currentBookmarks = globalSettings.peek().booru.bookmarks;
-          const exists = currentBookmarks.some(
-            (img) => img.id === this.id && img.api.value === this.api.value,
-          );
-          if (!exists) {
-            setGlobalSetting("booru.bookmarks", [
-              ...currentBookmarks,
-              this.toJSON(),
-            ]);
-          }
-        } else {
-          BooruImage._bookmarkKeys.delete(this.getBookmarkKey());
-          setGlobalSetting(
-            "booru.bookmarks",
-            globalSettings
-              .peek()
-              .booru.bookmarks.filter(
-                (img) =>
-                  !(img.id === this.id && img.api.value === this.api.value),
-              ),
-          );
-        }
+        keys.delete(this.getBookmarkKey());
       }
+      BooruImage.syncBookmarkCache(keys);
 
       this._isBookmarked = isBookmarked;
       notify({
@@ -732,6 +755,7 @@ export class BooruImage {
       extension: this.extension,
       url: this.url,
       preview: this.preview,
+      md5: this.md5,
     };
   }
 
@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+"""
+Benchmark for booru.py.
+
+Starts a local stand-in for the Danbooru, Gelbooru and Safebooru APIs,
+points the providers at it and measures post parsing, fetch_posts,
+fetch_tags and the bookmark actions. Reports p50/p95 latency, requests per
+second and peak RSS, as text or --json, to compare before/after a change.
+
+The stand-in serves synthetic posts shaped like each API's responses, or
+recorded ones with --fixtures DIR containing danbooru.json, gelbooru.json
+and/or safebooru.json (a post list as returned by the API).
+
+Usage:
+    booru-bench.py [--requests N] [--concurrency N] [--limit N]
+                   [--latency MS] [--jitter MS] [--error-rate R]
+                   [--bookmarks N] [--fixtures DIR] [--cache] [--json]
+"""
+
+import argparse
+import atexit
+import json
+import os
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+# booru.py derives every cache path from $HOME at import time, keep the
+# benchmark's caches and bookmarks away from the real ones (and drop them
+# when the run ends)
+_bench_home = tempfile.TemporaryDirectory(prefix="booru-bench-")
+atexit.register(_bench_home.cleanup)
+os.environ["HOME"] = _bench_home.name
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import booru  # noqa: E402
+
+TAG_POOL = [f"tag_{i}" for i in range(2000)]
+
+
+# ============================================================
+# Synthetic responses
+# ============================================================
+
+
+def danbooru_post(post_id: int, base: str) -> Dict[str, Any]:
+    rng = random.Random(post_id)
+    md5 = f"{post_id:032x}"
+    width, height = rng.choice([(1000, 1500), (2480, 3508), (1920, 1080)])
+    return {
+        "id": post_id,
+        "md5": md5,
+        "file_url": f"{base}/data/original/{md5}.jpg",
+        "file_ext": "jpg",
+        "image_width": width,
+        "image_height": height,
+        "tag_string": " ".join(rng.sample(TAG_POOL, rng.randint(15, 60))),
+        "rating": "g",
+        "score": rng.randint(0, 500),
+        "source": "https://example.com/artwork",
+        "media_asset": {
+            "variants": [
+                {
+                    "type": size,
+                    "url": f"{base}/data/{size}/{md5}.jpg",
+                    "width": width * scale // 1000,
+                    "height": height * scale // 1000,
+                    "file_ext": "jpg",
+                }
+                for size, scale in (
+                    ("180x180", 120),
+                    ("360x360", 240),
+                    ("720x720", 480),
+                    ("sample", 850),
+                    ("original", 1000),
+                )
+            ]
+        },
+    }
+
+
+def gelbooru_post(post_id: int, base: str) -> Dict[str, Any]:
+    rng = random.Random(post_id)
+    md5 = f"{post_id:032x}"
+    return {
+        "id": post_id,
+        "md5": md5,
+        "file_url": f"{base}/images/{md5}.png",
+        "preview_url": f"{base}/thumbnails/{md5}.jpg",
+        "sample_url": f"{base}/samples/{md5}.jpg",
+        "width": 2000,
+        "height": 3000,
+        "sample_width": 850,
+        "sample_height": 1275,
+        "tags": " ".join(rng.sample(TAG_POOL, rng.randint(15, 60))),
+        "rating": "general",
+        "score": rng.randint(0, 500),
+    }
+
+
+# ============================================================
+# Stand-in server
+# ============================================================
+
+
+class StandIn:
+    """Threaded local HTTP server answering the booru API routes."""
+
+    def __init__(
+        self,
+        latency: float,
+        jitter: float,
+        error_rate: float,
+        fixtures: Optional[Path] = None,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.recorded: Dict[str, List[Dict[str, Any]]] = {}
+        self.hits = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+        for api in ("danbooru", "gelbooru", "safebooru"):
+            path = fixtures / f"{api}.json" if fixtures else None
+            if path and path.exists():
+                posts = json.loads(path.read_text(encoding="utf-8"))
+                self.recorded[api] = (
+                    posts.get("post", []) if isinstance(posts, dict) else posts
+                )
+
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Send headers and body together, otherwise delayed ACKs add
+            # ~40 ms to every keep-alive request and swamp the measurement
+            wbufsize = 64 * 1024
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                standin.serve(self)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.base = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def posts(self, api: str, page: int, limit: int) -> List[Dict[str, Any]]:
+        recorded = self.recorded.get(api)
+        if recorded:
+            start = (page - 1) * limit % len(recorded)
+            return [recorded[(start + i) % len(recorded)] for i in range(limit)]
+        make = gelbooru_post if api == "gelbooru" else danbooru_post
+        return [make((page - 1) * limit + i + 1, self.base) for i in range(limit)]
+
+    @staticmethod
+    def tags(query: str, limit: int) -> List[Dict[str, Any]]:
+        names = [t for t in TAG_POOL if query in t][:limit]
+        return [{"name": t, "post_count": 10000 - i} for i, t in enumerate(names)]
+
+    def serve(self, handler: BaseHTTPRequestHandler) -> None:
+        with self._lock:
+            self.hits += 1
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+
+        if random.random() < self.error_rate:
+            with self._lock:
+                self.errors += 1
+            self.send(handler, b"", 503, {"Retry-After": "0"})
+            return
+
+        url = urlparse(handler.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        api, _, route = url.path.strip("/").partition("/")
+        limit = int(query.get("limit", 6))
+
+        if api == "gelbooru":
+            if query.get("s") == "tag":
+                body = {
+                    "tag": self.tags(query.get("name_pattern", "").strip("%"), limit)
+                }
+            else:
+                page = int(query.get("pid", 0)) + 1
+                body = {"post": self.posts(api, page, limit)}
+        elif route == "posts.json":
+            body = self.posts(api, int(query.get("page", 1)), limit)
+        elif route.startswith("posts/"):
+            body = self.posts(api, int(route[6:].split(".")[0]), 1)[0]
+        elif route == "tags.json":
+            body = self.tags(query.get("search[name_matches]", "").strip("*"), limit)
+        else:
+            self.send(handler, b"", 404)
+            return
+
+        self.send(handler, json.dumps(body).encode("utf-8"), 200)
+
+    @staticmethod
+    def send(
+        handler: BaseHTTPRequestHandler,
+        body: bytes,
+        status: int,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> None:
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(body)
+
+
+# ============================================================
+# Measurements
+# ============================================================
+
+
+def summarize(latencies: List[float], elapsed: float, failures: int) -> Dict[str, Any]:
+    ordered = sorted(latencies)
+    return {
+        "count": len(ordered),
+        "failures": failures,
+        "p50_ms": round(statistics.median(ordered) * 1000, 3) if ordered else None,
+        "p95_ms": (
+            round(ordered[int(0.95 * (len(ordered) - 1))] * 1000, 3)
+            if ordered
+            else None
+        ),
+        "rps": round(len(ordered) / elapsed, 1) if elapsed else None,
+    }
+
+
+def run_concurrently(
+    call: Callable[[int], Any], requests: int, concurrency: int
+) -> Dict[str, Any]:
+    """Run call(0..requests-1) on `concurrency` threads, timing each call."""
+    latencies: List[float] = []
+    failures = 0
+    lock = threading.Lock()
+
+    def timed(i: int) -> None:
+        nonlocal failures
+        start = time.perf_counter()
+        try:
+            call(i)
+        except Exception:
+            with lock:
+                failures += 1
+            return
+        with lock:
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(timed, range(requests)))
+    return summarize(latencies, time.perf_counter() - start, failures)
+
+
+def bench_parse(standin: StandIn, api: str, count: int) -> Dict[str, Any]:
+    provider = booru.get_provider(api, "bench", "bench")
+    posts = standin.posts(api, 1, count)
+    start = time.perf_counter()
+    valid = sum(1 for post in posts if provider.normalize_post(post))
+    elapsed = time.perf_counter() - start
+    return {
+        "posts": count,
+        "valid": valid,
+        "us_per_post": round(elapsed / count * 1e6, 2),
+    }
+
+
+def bench_bookmarks(count: int) -> Dict[str, Any]:
+    results = {}
+    bookmarks = [
+        {
+            "id": i,
+            "api": {"value": random.choice(["danbooru", "gelbooru", "safebooru"])},
+            "url": f"https://example.com/{i}.jpg",
+            "tags": random.sample(TAG_POOL[:300], 20),
+        }
+        for i in range(count)
+    ]
+
+    start = time.perf_counter()
+    booru.run_bookmark_action(
+        "batch",
+        {"operations": [{"op": "add", "bookmark": b} for b in bookmarks]},
+    )
+    results["batch_add_ms"] = round((time.perf_counter() - start) * 1000, 1)
+
+    results["toggle"] = run_concurrently(
+        lambda i: booru.run_bookmark_action(
+            "toggle-bookmark", {"bookmark": bookmarks[i % count]}
+        ),
+        200,
+        1,
+    )
+    results["list_page"] = run_concurrently(
+        lambda i: booru.run_bookmark_action(
+            "list-bookmarks", {"offset": i * 10 % count, "limit": 50}
+        ),
+        200,
+        1,
+    )
+    results["tag_search"] = run_concurrently(
+        lambda i: booru.run_bookmark_action(
+            "list-bookmarks",
+            {"tags": [TAG_POOL[i % 300], f"-{TAG_POOL[(i + 1) % 300]}"], "limit": 50},
+        ),
+        200,
+        1,
+    )
+
+    start = time.perf_counter()
+    booru.run_bookmark_action("compact-bookmarks", {})
+    results["compact_ms"] = round((time.perf_counter() - start) * 1000, 1)
+    return results
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in KiB on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+# ============================================================
+# CLI
+# ============================================================
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark booru.py providers.")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--limit", type=int, default=20, help="posts per page")
+    parser.add_argument("--latency", type=float, default=20, help="server ms")
+    parser.add_argument("--jitter", type=float, default=10, help="extra random ms")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--bookmarks", type=int, default=10000)
+    parser.add_argument("--fixtures", type=Path)
+    parser.add_argument(
+        "--cache", action="store_true", help="keep the response cache enabled"
+    )
+    parser.add_argument("--json", action="store_true", help="print a JSON report")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    standin = StandIn(
+        args.latency / 1000, args.jitter / 1000, args.error_rate, args.fixtures
+    )
+
+    booru.DanbooruProvider.BASE = f"{standin.base}/danbooru"
+    booru.SafebooruProvider.BASE = f"{standin.base}/safebooru"
+    booru.GelbooruProvider.BASE = f"{standin.base}/gelbooru/index.php"
+    # Measure booru.py, not the politeness budget meant for the real sites
+    booru.RATE_LIMITS[urlparse(standin.base).netloc] = 1e6
+    booru.set_pool_size(args.concurrency)
+    booru.set_response_cache_enabled(args.cache)
+
+    report: Dict[str, Any] = {"config": vars(args) | {"fixtures": str(args.fixtures)}}
+    for api in ("danbooru", "gelbooru", "safebooru"):
+        provider = booru.get_provider(api, "bench", "bench")
+        report[api] = {
+            "parse": bench_parse(standin, api, 2000),
+            "fetch_posts": run_concurrently(
+                lambda i: provider.fetch_posts(["tag_1"], "random", i + 1, args.limit),
+                args.requests,
+                args.concurrency,
+            ),
+            "fetch_tags": run_concurrently(
+                lambda i: provider.fetch_tags(f"tag_{i % 200}"),
+                args.requests,
+                args.concurrency,
+            ),
+        }
+    report["bookmarks"] = bench_bookmarks(args.bookmarks)
+    report["server"] = {"hits": standin.hits, "injected_errors": standin.errors}
+    report["peak_rss_mb"] = peak_rss_mb()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    for section, results in report.items():
+        if section == "config":
+            continue
+        print(f"{section}:")
+        if not isinstance(results, dict):
+            print(f"  {results}")
+            continue
+        for name, value in results.items():
+            print(f"  {name:<12} {json.dumps(value)}")
+
+
+if __name__ == "__main__":
+    main()
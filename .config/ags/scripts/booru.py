@@ -1,13 +1,31 @@
 #!/usr/bin/env python3
 
+import bisect
+import codecs
+import fcntl
+import hashlib
+import heapq
+import itertools
 import json
+import math
 import os
+import queue
+import random
+import socketserver
+import subprocess
 import sys
+import threading
+import time
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
 from pathlib import Path
-from typing import List, Optional, Dict, Any
+from typing import Callable, Iterable, Iterator, List, Optional, Dict, Any, Tuple
+from urllib.parse import urlsplit
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 
 
@@ -30,7 +48,91 @@ def emit_error(error: "ErrorResponse") -> None:
     print(json.dumps(error.to_dict()), file=sys.stderr)
 
 
+def atomic_write_text(path: Path, text: str, fsync: bool = False) -> None:
+    """
+    Replace `path` with `text` through a temporary file, so readers see the
+    old or the new content, never a partial write. Raises OSError.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+def atomic_write_json(path: Path, data: Any, fsync: bool = False) -> None:
+    """atomic_write_text of `data` as compact JSON."""
+    atomic_write_text(path, json.dumps(data, separators=(",", ":")), fsync)
+
+
+@contextmanager
+def locked_json_file(path: Path, default: Any) -> Iterator[Any]:
+    """
+    Read-modify-write of a small JSON file shared between processes, under
+    an exclusive lock on the file itself. Yields its content, or `default`
+    when it is missing, unreadable or of another type, and writes the
+    yielded object back unless the block raised.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a+", encoding="utf-8") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        try:
+            data = json.loads(f.read() or "null")
+        except json.JSONDecodeError:
+            data = None
+        if not isinstance(data, type(default)):
+            data = default
+        yield data
+
+        f.seek(0)
+        f.truncate()
+        f.write(json.dumps(data, separators=(",", ":")))
+
+
+def log_records(path: Path) -> Iterator[Any]:
+    """Records of a JSON-lines log, skipping torn or invalid lines."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+    except OSError:
+        return
+
+
+@contextmanager
+def taken_log(path: Path) -> Iterator[Optional[Iterator[Any]]]:
+    """
+    Take a pending JSON-lines log over for folding, yielding its records,
+    or None when there is none. The log is renamed away first so records
+    appended meanwhile start a new log instead of being lost; the taken
+    file is removed when the block exits.
+    """
+    taken = path.with_suffix(f".{os.getpid()}.folding")
+    try:
+        os.replace(path, taken)
+    except OSError:
+        yield None
+        return
+    try:
+        yield log_records(taken)
+    finally:
+        taken.unlink(missing_ok=True)
+
+
 SETTINGS_PATH = Path.home() / ".config" / "ags" / "cache" / "settings" / "settings.json"
+BOORU_CACHE_DIR = Path.home() / ".config" / "ags" / "cache" / "booru"
+BOOKMARKS_PATH = BOORU_CACHE_DIR / "bookmarks.json"
 SUPPORTED_APIS = {"danbooru", "gelbooru", "safebooru"}
 
 
@@ -44,30 +146,6 @@ def read_settings() -> Dict[str, Any]:
         raise Exception(f"Failed to read settings file: {str(exc)}")
 
 
-def write_settings(data: Dict[str, Any]) -> None:
-    try:
-        SETTINGS_PATH.parent.mkdir(parents=True, exist_ok=True)
-        tmp_path = SETTINGS_PATH.with_suffix(f"{SETTINGS_PATH.suffix}.tmp")
-        tmp_path.write_text(json.dumps(data, indent=4), encoding="utf-8")
-        os.replace(tmp_path, SETTINGS_PATH)
-    except Exception as exc:
-        raise Exception(f"Failed to write settings file: {str(exc)}")
-
-
-def ensure_booru_bookmarks(settings_data: Dict[str, Any]) -> List[Dict[str, Any]]:
-    booru_data = settings_data.get("booru")
-    if not isinstance(booru_data, dict):
-        booru_data = {}
-        settings_data["booru"] = booru_data
-
-    bookmarks = booru_data.get("bookmarks")
-    if not isinstance(bookmarks, list):
-        bookmarks = []
-        booru_data["bookmarks"] = bookmarks
-
-    return bookmarks
-
-
 def normalize_api_value(bookmark: Dict[str, Any]) -> str:
     api_data = bookmark.get("api")
     if isinstance(api_data, dict):
@@ -78,22 +156,14 @@ def normalize_api_value(bookmark: Dict[str, Any]) -> str:
     return ""
 
 
-def bookmark_match(bookmark: Dict[str, Any], target_id: int, target_api: str) -> bool:
-    bookmark_id = bookmark.get("id")
-    if not isinstance(bookmark_id, int):
-        return False
-    return bookmark_id == target_id and normalize_api_value(bookmark) == target_api
+BookmarkKey = Tuple[str, int]
 
 
-def find_bookmark_index(
-    bookmarks: List[Dict[str, Any]], target_id: int, target_api: str
-) -> int:
-    for index, bookmark in enumerate(bookmarks):
-        if isinstance(bookmark, dict) and bookmark_match(
-            bookmark, target_id, target_api
-        ):
-            return index
-    return -1
+def bookmark_key(bookmark: Dict[str, Any]) -> Optional[BookmarkKey]:
+    bookmark_id = bookmark.get("id")
+    if not isinstance(bookmark_id, int):
+        return None
+    return (normalize_api_value(bookmark), bookmark_id)
 
 
 def validate_bookmark_payload(payload: Dict[str, Any]) -> Dict[str, Any]:
@@ -116,456 +186,2051 @@ def validate_bookmark_payload(payload: Dict[str, Any]) -> Dict[str, Any]:
     return bookmark
 
 
-def list_bookmarks_action(_: Dict[str, Any]) -> List[Dict[str, Any]]:
-    settings_data = read_settings()
-    bookmarks = ensure_booru_bookmarks(settings_data)
-    return [bookmark for bookmark in bookmarks if isinstance(bookmark, dict)]
+class BookmarkStore:
+    """
+    Booru bookmarks, kept apart from the general AGS settings.
+    Bookmarks are indexed by (api, id) in insertion order, so membership
+    checks and updates don't scan the collection, by tag, so tag searches
+    only touch matching bookmarks, and by canonical md5, so the same
+    artwork bookmarked from another booru counts as already bookmarked.
+    On first use the store is
+    seeded from the legacy booru.bookmarks list in settings.json.
+
+    Mutations are appended to a journal (one JSON line per change set, so a
+    torn write loses at most that change set) and folded into the snapshot
+    by compaction. Replaying the journal is idempotent, so a crash between
+    writing the snapshot and truncating the journal is harmless.
+
+    Several processes may share the store: mutations and compaction run
+    under an advisory lock on bookmarks.lock and first catch up with the
+    records other writers appended, so concurrent changes are merged into
+    the journal instead of overwriting each other. Catching up re-reads the
+    snapshot only when its mtime or inode changed, and the journal only
+    past the last offset read. That offset is only trusted for the journal
+    it was read from: each journal starts with a header line carrying a
+    random id, and a journal with another inode or id is read from the
+    start.
+    """
+
+    COMPACT_OPS = 500
+    COMPACT_BYTES = 256 * 1024
+
+    def __init__(self, path: Optional[Path] = None):
+        self.path = path or BOOKMARKS_PATH
+        self.journal_path = self.path.with_suffix(".journal")
+        self.bookmarks: Dict[BookmarkKey, Dict[str, Any]] = {}
+        self._by_api: Dict[str, Dict[BookmarkKey, None]] = {}
+        self._by_tag: Dict[str, Dict[BookmarkKey, None]] = {}
+        self._by_md5: Dict[str, BookmarkKey] = {}
+        # Insertion rank of each key, for ordering tag search results
+        self._seq: Dict[BookmarkKey, int] = {}
+        self._next_seq = 0
+        self._sorted: Dict[str, List[BookmarkKey]] = {}
+        self.lock_path = self.path.with_suffix(".lock")
+        # (mtime_ns, inode) of the snapshot last read, STALE forces a re-read
+        self._stamp: Optional[Tuple[int, int]] = None
+        self._journal_offset = 0
+        self._journal_ops = 0
+        # (inode, header id) of the journal _journal_offset refers to
+        self._journal_id: Optional[Tuple[int, Optional[str]]] = None
+        self._transaction: Optional[List[Dict[str, Any]]] = None
+        self._thread_lock = threading.RLock()
+        self._lock_depth = 0
+
+    STALE = (-1, -1)
+
+    @contextmanager
+    def locked(self) -> Iterator[None]:
+        """
+        Hold the cross-process bookmark lock, caught up with other writers.
+        Re-entrant, so mutations inside a locked block don't lock again.
+        """
+        with self._thread_lock:
+            if self._lock_depth:
+                self._lock_depth += 1
+                try:
+                    yield
+                finally:
+                    self._lock_depth -= 1
+                return
+
+            self.lock_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.lock_path, "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                self._lock_depth = 1
+                try:
+                    self.load()
+                    yield
+                finally:
+                    self._lock_depth = 0
+
+    def load(self) -> None:
+        """Bring the in-memory state up to date with the snapshot and journal."""
+        try:
+            stat = self.path.stat()
+            stamp = (stat.st_mtime_ns, stat.st_ino)
+        except FileNotFoundError:
+            if self._stamp is None:
+                self._migrate_from_settings()
+                return
+            stamp = self._stamp
+
+        if stamp != self._stamp:
+            try:
+                data = json.loads(self.path.read_text(encoding="utf-8"))
+            except Exception as exc:
+                raise Exception(f"Failed to read bookmarks file: {str(exc)}")
+
+            self._reset()
+            self._index(data.get("bookmarks", []) if isinstance(data, dict) else [])
+            self._stamp = stamp
+            self._journal_offset = 0
+            self._journal_ops = 0
+
+        self._replay_journal()
+
+        # Compaction rewrites shared files, only do it while holding the lock
+        if self._lock_depth and (
+            self._journal_ops >= self.COMPACT_OPS
+            or self._journal_offset >= self.COMPACT_BYTES
+        ):
+            self.compact()
+
+    def _index(self, bookmarks: List[Any]) -> None:
+        for bookmark in bookmarks:
+            if isinstance(bookmark, dict):
+                key = bookmark_key(bookmark)
+                if key and key not in self.bookmarks:
+                    self._put(key, bookmark)
+
+    def _reset(self) -> None:
+        self.bookmarks = {}
+        self._by_api = {}
+        self._by_tag = {}
+        self._by_md5 = {}
+        self._seq = {}
+        self._sorted = {}
+
+    @staticmethod
+    def _content_hash(bookmark: Dict[str, Any]) -> Optional[str]:
+        md5 = bookmark.get("md5")
+        return get_content_index().canonical(md5) if isinstance(md5, str) else None
+
+    @staticmethod
+    def _tags(bookmark: Dict[str, Any]) -> set:
+        tags = bookmark.get("tags")
+        return {str(tag).lower() for tag in tags} if isinstance(tags, list) else set()
+
+    def _put(self, key: BookmarkKey, bookmark: Dict[str, Any]) -> None:
+        previous = self.bookmarks.get(key)
+        if previous is not None:
+            self._unindex_tags(key, previous)
+        else:
+            self._seq[key] = self._next_seq
+            self._next_seq += 1
+        self.bookmarks[key] = bookmark
+        self._by_api.setdefault(key[0], {})[key] = None
+        for tag in self._tags(bookmark):
+            self._by_tag.setdefault(tag, {})[key] = None
+        content_hash = self._content_hash(bookmark)
+        if content_hash:
+            self._by_md5.setdefault(content_hash, key)
+        self._sorted.clear()
+
+    def _drop(self, key: BookmarkKey) -> None:
+        bookmark = self.bookmarks.pop(key, None)
+        if bookmark is None:
+            return
+        self._by_api.get(key[0], {}).pop(key, None)
+        self._unindex_tags(key, bookmark)
+        content_hash = self._content_hash(bookmark)
+        if content_hash and self._by_md5.get(content_hash) == key:
+            del self._by_md5[content_hash]
+        self._seq.pop(key, None)
+        self._sorted.clear()
+
+    def _unindex_tags(self, key: BookmarkKey, bookmark: Dict[str, Any]) -> None:
+        for tag in self._tags(bookmark):
+            keys = self._by_tag.get(tag)
+            if keys is not None:
+                keys.pop(key, None)
+                if not keys:
+                    del self._by_tag[tag]
+
+    @staticmethod
+    def _header_id(line: bytes) -> Optional[str]:
+        try:
+            header = json.loads(line)
+        except json.JSONDecodeError:
+            return None
+        return header.get("journal") if isinstance(header, dict) else None
+
+    def _replay_journal(self) -> None:
+        """Apply journal entries written since the last replay."""
+        try:
+            f = open(self.journal_path, "rb")
+        except FileNotFoundError:
+            self._journal_id = None
+            self._journal_offset = 0
+            self._journal_ops = 0
+            return
+
+        with f:
+            journal_id = (os.fstat(f.fileno()).st_ino, self._header_id(f.readline()))
+            if journal_id != self._journal_id:
+                # Compacted and restarted by another writer since our last
+                # read: the offset belongs to the old file
+                self._journal_id = journal_id
+                self._journal_offset = 0
+                self._journal_ops = 0
+
+            f.seek(self._journal_offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # torn write, dropped on the next append
+                self._journal_offset += len(line)
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                ops = entry.get("ops", []) if isinstance(entry, dict) else []
+                self._apply_in_memory(ops)
+                self._journal_ops += len(ops)
+
+    def _apply_in_memory(self, ops: List[Dict[str, Any]]) -> None:
+        for op in ops:
+            if op.get("op") == "add":
+                self._index([op.get("bookmark")])
+            elif op.get("op") == "remove":
+                api_value, bookmark_id = op.get("key", ("", None))
+                self._drop((api_value, bookmark_id))
+
+    def _migrate_from_settings(self) -> None:
+        booru_data = read_settings().get("booru")
+        legacy = booru_data.get("bookmarks") if isinstance(booru_data, dict) else None
+        self._reset()
+        if isinstance(legacy, list):
+            self._index(legacy)
+        with self.locked():
+            # Another process may have written the snapshot first, keep it
+            if not self.path.exists():
+                self.compact()
+
+    def apply(self, ops: List[Dict[str, Any]]) -> None:
+        """Apply a change set and append it to the journal as a single record."""
+        if not ops:
+            return
+        if self._transaction is not None:
+            self._apply_in_memory(ops)
+            self._transaction.extend(ops)
+            return
+        with self.locked():
+            self._apply_in_memory(ops)
+            self._append(ops)
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        """
+        Group every change made inside the block into one journal record.
+        The lock is held for the whole block, so decisions taken on the
+        current state (toggles, membership checks) stay valid until written.
+        """
+        with self.locked():
+            self._transaction = []
+            try:
+                yield
+                ops, self._transaction = self._transaction, None
+                if ops:
+                    self._append(ops)
+            except Exception:
+                self._transaction = None
+                self._stamp = self.STALE  # in-memory state is suspect, reload
+                raise
+
+    def _append(self, ops: List[Dict[str, Any]]) -> None:
+        record = (json.dumps({"ops": ops}, separators=(",", ":")) + "\n").encode(
+            "utf-8"
+        )
+        try:
+            self.journal_path.parent.mkdir(parents=True, exist_ok=True)
+            # Held under the lock: after this, all that can follow the offset
+            # is a torn record left by a crashed writer
+            self._replay_journal()
+            with open(self.journal_path, "a+b") as f:
+                end = f.seek(0, os.SEEK_END)
+                if end == 0:
+                    journal_id = os.urandom(8).hex()
+                    header = json.dumps({"journal": journal_id}) + "\n"
+                    f.write(header.encode("utf-8"))
+                    self._journal_id = (os.fstat(f.fileno()).st_ino, journal_id)
+                    self._journal_offset = len(header)
+                elif end > self._journal_offset:
+                    f.seek(self._journal_offset)
+                    if b"\n" in f.read():
+                        raise Exception("journal has records that were not read")
+                    f.truncate(self._journal_offset)
+                f.write(record)
+                f.flush()
+                os.fsync(f.fileno())
+            self._journal_offset += len(record)
+            self._journal_ops += len(ops)
+        except Exception as exc:
+            self._stamp = self.STALE
+            raise Exception(f"Failed to write bookmarks journal: {str(exc)}")
+
+    def compact(self) -> None:
+        """Fold the journal into a fresh snapshot and truncate it."""
+        with self.locked():
+            self._write_snapshot()
+
+    def _write_snapshot(self) -> None:
+        try:
+            atomic_write_json(
+                self.path, {"bookmarks": list(self.bookmarks.values())}, fsync=True
+            )
+            self.journal_path.unlink(missing_ok=True)
+            stat = self.path.stat()
+            self._stamp = (stat.st_mtime_ns, stat.st_ino)
+            self._journal_id = None
+            self._journal_offset = 0
+            self._journal_ops = 0
+        except Exception as exc:
+            raise Exception(f"Failed to write bookmarks file: {str(exc)}")
+
+    @property
+    def pending_ops(self) -> int:
+        return self._journal_ops
+
+    def __contains__(self, key: BookmarkKey) -> bool:
+        return key in self.bookmarks
+
+    def match(self, bookmark: Dict[str, Any]) -> Optional[BookmarkKey]:
+        """Key of the stored bookmark for this post or the same content, if any."""
+        key = bookmark_key(bookmark)
+        if key in self.bookmarks:
+            return key
+        content_hash = self._content_hash(bookmark)
+        return self._by_md5.get(content_hash) if content_hash else None
+
+    def add(self, bookmark: Dict[str, Any]) -> bool:
+        key = bookmark_key(bookmark)
+        if key is None or self.match(bookmark):
+            return False
+        self.apply([{"op": "add", "bookmark": bookmark}])
+        return True
+
+    def remove(self, key: BookmarkKey) -> bool:
+        if key not in self.bookmarks:
+            return False
+        self.apply([{"op": "remove", "key": list(key)}])
+        return True
+
+    def all(self) -> List[Dict[str, Any]]:
+        return list(self.bookmarks.values())
+
+    def _ordered_keys(self, sort: str) -> List[BookmarkKey]:
+        """Keys in the requested order; sorted views are cached until the next change."""
+        if sort == "insertion":
+            return list(self.bookmarks)
+        ordered = self._sorted.get(sort)
+        if ordered is None:
+            if sort == "id":
+                ordered = sorted(self.bookmarks, key=lambda key: key[1])
+            else:
+                ordered = [
+                    key for api in sorted(self._by_api) for key in self._by_api[api]
+                ]
+            self._sorted[sort] = ordered
+        return ordered
+
+    def _sort_key(self, sort: str) -> Callable[[BookmarkKey], Any]:
+        """Sort key giving the same order as _ordered_keys(sort)."""
+        if sort == "id":
+            return lambda key: (key[1], self._seq[key])
+        if sort == "api":
+            return lambda key: (key[0], self._seq[key])
+        return self._seq.__getitem__
+
+    def query(
+        self,
+        offset: int = 0,
+        limit: int = 0,
+        sort: str = "insertion",
+        descending: bool = False,
+        apis: Optional[List[str]] = None,
+        tags: Optional[List[str]] = None,
+    ) -> Tuple[int, List[Dict[str, Any]]]:
+        """
+        One page of bookmarks matching the filters, plus the total match count.
+        Bookmarks must carry every tag in `tags`, and none of those written
+        as -tag. Required tags are answered from the tag index, smallest
+        posting list first, and only the matches get ordered.
+        """
+        wanted = {t.strip().lower() for t in tags or () if t and t.strip()}
+        excluded = {t[1:] for t in wanted if t.startswith("-") and len(t) > 1}
+        required = sorted(
+            (self._by_tag.get(t, {}) for t in wanted if not t.startswith("-")),
+            key=len,
+        )
+
+        skip = set().union(*(self._by_tag.get(t, {}) for t in excluded))
+        allowed = set(apis) if apis else None
+
+        if required:
+            matched = set(required[0]).intersection(*required[1:]) - skip
+            if allowed is not None:
+                matched = {key for key in matched if key[0] in allowed}
+            sort_key = self._sort_key(sort)
+            if limit > 0:
+                # Only the keys up to the requested page need ordering
+                pick = heapq.nlargest if descending else heapq.nsmallest
+                page = pick(offset + limit, matched, key=sort_key)[offset:]
+            else:
+                page = sorted(matched, key=sort_key, reverse=descending)[offset:]
+            return len(matched), [self.bookmarks[key] for key in page]
+
+        keys: Any = self._ordered_keys(sort)
+        if descending:
+            keys = reversed(keys)
+
+        if skip:
+            keys = (key for key in keys if key not in skip)
+
+        if allowed is not None:
+            keys = (key for key in keys if key[0] in allowed)
+
+        matches = list(keys)
+        page = matches[offset : offset + limit] if limit > 0 else matches[offset:]
+        return len(matches), [self.bookmarks[key] for key in page]
+
+
+_bookmark_store: Optional[BookmarkStore] = None
+
+
+def get_bookmark_store(load: bool = True) -> BookmarkStore:
+    """The process-wide store; load=False skips catching up, for callers about to lock."""
+    global _bookmark_store
+    if _bookmark_store is None:
+        _bookmark_store = BookmarkStore()
+    if load:
+        _bookmark_store.load()
+    return _bookmark_store
+
+
+def bookmark_action_result(
+    payload: Dict[str, Any],
+    store: BookmarkStore,
+    bookmark: Dict[str, Any],
+    bookmarked: bool,
+    changed: bool,
+) -> Dict[str, Any]:
+    """Result of a bookmark mutation: the delta, plus the full list on request."""
+    result = {"bookmarked": bookmarked, "changed": changed, "bookmark": bookmark}
+    if payload.get("include_bookmarks"):
+        result["bookmarks"] = store.all()
+    return result
+
+
+BOOKMARK_LIST_QUERY_KEYS = {"offset", "limit", "sort", "order", "api", "tags"}
+BOOKMARK_SORTS = {"insertion", "id", "api"}
+
+
+def list_bookmarks_action(payload: Dict[str, Any]) -> Any:
+    """
+    Without query keys, returns every bookmark (legacy array response).
+    With offset/limit/sort/order/api/tags, returns one page and the total.
+    tags are ANDed together; a -tag excludes bookmarks carrying it.
+    """
+    store = get_bookmark_store()
+    if not BOOKMARK_LIST_QUERY_KEYS & payload.keys():
+        return store.all()
+
+    try:
+        offset = max(0, int(payload.get("offset", 0)))
+        limit = max(0, int(payload.get("limit", 0)))
+    except (TypeError, ValueError):
+        raise Exception("payload.offset and payload.limit must be integers")
+
+    sort = payload.get("sort", "insertion")
+    if sort not in BOOKMARK_SORTS:
+        raise Exception("payload.sort must be one of insertion, id, or api")
+
+    apis = payload.get("api")
+    if isinstance(apis, str):
+        apis = [apis]
+    tags = payload.get("tags")
+    if isinstance(tags, str):
+        tags = tags.split(",")
+
+    total, bookmarks = store.query(
+        offset=offset,
+        limit=limit,
+        sort=sort,
+        descending=payload.get("order") == "desc",
+        apis=apis,
+        tags=tags,
+    )
+    return {"total": total, "offset": offset, "limit": limit, "bookmarks": bookmarks}
+
+
+def bookmark_keys_action(_: Dict[str, Any]) -> Dict[str, Any]:
+    """Every bookmark as an "id:api" key, for clients that only need membership."""
+    store = get_bookmark_store()
+    return {"keys": [f"{bookmark_id}:{api}" for api, bookmark_id in store.bookmarks]}
+
+
+def duplicate_of(
+    store: BookmarkStore, bookmark: Dict[str, Any]
+) -> Optional[Dict[str, Any]]:
+    """The bookmark holding the same content under another (api, id), if any."""
+    existing = store.match(bookmark)
+    if existing and existing != bookmark_key(bookmark):
+        return store.bookmarks[existing]
+    return None
 
 
 def add_bookmark_action(payload: Dict[str, Any]) -> Dict[str, Any]:
     bookmark = validate_bookmark_payload(payload)
-    bookmark_id = bookmark["id"]
-    api_value = str(bookmark["api"]["value"])
-
-    settings_data = read_settings()
-    bookmarks = ensure_booru_bookmarks(settings_data)
+    store = get_bookmark_store()
 
-    existing_index = find_bookmark_index(bookmarks, bookmark_id, api_value)
-    if existing_index == -1:
-        bookmarks.append(bookmark)
-        write_settings(settings_data)
+    changed = store.add(bookmark)
+    result = bookmark_action_result(payload, store, bookmark, True, changed)
 
-    return {
-        "bookmarked": True,
-        "bookmarks": [b for b in bookmarks if isinstance(b, dict)],
-    }
+    duplicate = duplicate_of(store, bookmark)
+    if duplicate:
+        result["duplicate_of"] = duplicate
+    return result
 
 
 def remove_bookmark_action(payload: Dict[str, Any]) -> Dict[str, Any]:
     bookmark = validate_bookmark_payload(payload)
-    bookmark_id = bookmark["id"]
-    api_value = str(bookmark["api"]["value"])
+    store = get_bookmark_store()
 
-    settings_data = read_settings()
-    bookmarks = ensure_booru_bookmarks(settings_data)
+    # Only the exact post: a duplicate from another booru stays bookmarked
+    changed = store.remove(bookmark_key(bookmark))
 
-    existing_index = find_bookmark_index(bookmarks, bookmark_id, api_value)
-    if existing_index != -1:
-        bookmarks.pop(existing_index)
-        write_settings(settings_data)
-
-    return {
-        "bookmarked": False,
-        "bookmarks": [b for b in bookmarks if isinstance(b, dict)],
-    }
+    return bookmark_action_result(payload, store, bookmark, False, changed)
 
 
 def toggle_bookmark_action(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Remove the exact post if bookmarked, otherwise add it. Adding content
+    already bookmarked from another booru changes nothing and reports
+    that bookmark as duplicate_of.
+    """
     bookmark = validate_bookmark_payload(payload)
-    bookmark_id = bookmark["id"]
-    api_value = str(bookmark["api"]["value"])
+    if bookmark_key(bookmark) in get_bookmark_store():
+        return remove_bookmark_action(payload)
+    return add_bookmark_action(payload)
 
-    settings_data = read_settings()
-    bookmarks = ensure_booru_bookmarks(settings_data)
 
-    existing_index = find_bookmark_index(bookmarks, bookmark_id, api_value)
-    if existing_index == -1:
-        bookmarks.append(bookmark)
-        is_bookmarked = True
-    else:
-        bookmarks.pop(existing_index)
-        is_bookmarked = False
+BATCH_OPERATIONS = {"add", "remove", "toggle"}
 
-    write_settings(settings_data)
 
-    return {
-        "bookmarked": is_bookmarked,
-        "bookmarks": [b for b in bookmarks if isinstance(b, dict)],
+def batch_bookmarks_action(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Apply many add/remove/toggle operations with a single journal write.
+    Invalid operations are reported per item and skipped; the valid ones are
+    committed together or not at all.
+    """
+    operations = payload.get("operations")
+    if not isinstance(operations, list):
+        raise Exception("payload.operations must be an array")
+
+    store = get_bookmark_store()
+    results: List[Dict[str, Any]] = []
+
+    with store.transaction():
+        for index, operation in enumerate(operations):
+            try:
+                if not isinstance(operation, dict):
+                    raise Exception("operation must be an object")
+                kind = operation.get("op")
+                if kind not in BATCH_OPERATIONS:
+                    raise Exception("operation.op must be add, remove, or toggle")
+
+                bookmark = validate_bookmark_payload(operation)
+                key = bookmark_key(bookmark)
+                if kind == "toggle":
+                    kind = "remove" if key in store else "add"
+
+                if kind == "add":
+                    changed = store.add(bookmark)
+                else:
+                    changed = store.remove(key)
+
+                outcome = {
+                    "index": index,
+                    "ok": True,
+                    "id": key[1],
+                    "api": key[0],
+                    "bookmarked": kind == "add",
+                    "changed": changed,
+                }
+                duplicate = duplicate_of(store, bookmark) if kind == "add" else None
+                if duplicate:
+                    outcome["duplicate_of"] = duplicate
+                results.append(outcome)
+            except Exception as e:
+                results.append({"index": index, "ok": False, "error": str(e)})
+
+    result: Dict[str, Any] = {
+        "results": results,
+        "changed": sum(1 for r in results if r.get("changed")),
     }
+    if payload.get("include_bookmarks"):
+        result["bookmarks"] = store.all()
+    return result
+
+
+def compact_bookmarks_action(_: Dict[str, Any]) -> Dict[str, Any]:
+    store = get_bookmark_store()
+    folded = store.pending_ops
+    store.compact()
+    return {"compacted": folded, "count": len(store.bookmarks)}
 
 
 def run_bookmark_action(action: str, payload: Dict[str, Any]) -> Any:
     actions = {
         "list-bookmarks": list_bookmarks_action,
+        "bookmark-keys": bookmark_keys_action,
         "add-bookmark": add_bookmark_action,
         "remove-bookmark": remove_bookmark_action,
         "toggle-bookmark": toggle_bookmark_action,
+        "batch": batch_bookmarks_action,
+        "compact-bookmarks": compact_bookmarks_action,
     }
     handler = actions.get(action)
     if not handler:
         raise Exception(
-            f"Unsupported action '{action}'. Use list-bookmarks, add-bookmark, remove-bookmark, or toggle-bookmark."
+            f"Unsupported action '{action}'. Use list-bookmarks, bookmark-keys, add-bookmark, remove-bookmark, toggle-bookmark, batch, or compact-bookmarks."
         )
 
-    return handler(payload)
+    if action in ("list-bookmarks", "bookmark-keys"):
+        return handler(payload)
+    # Check-then-write actions (toggle above all) must see other processes'
+    # changes and keep them out until written. Loading happens under the lock
+    with get_bookmark_store(load=False).locked():
+        return handler(payload)
 
 
 # ============================================================
-# Provider interface
+# HTTP sessions
 # ============================================================
 
 
-class BooruProvider(ABC):
-    @abstractmethod
-    def fetch_posts(
-        self,
-        tags: List[str],
-        post_id: str = "random",
-        page: int = 1,
-        limit: int = 6,
-    ) -> Optional[List[Dict[str, Any]]]:
-        pass
+USER_AGENT = "AGSBooruViewer/1.0 (ArchLinux; Hyprland)"
+REQUEST_TIMEOUT = 15
+POOL_SIZE = int(os.environ.get("AGS_BOORU_POOL_SIZE", "8"))
 
-    @abstractmethod
-    def fetch_tags(self, tag: str, limit: int = 10) -> List[str]:
-        pass
+_sessions: Dict[Tuple[str, Any], requests.Session] = {}
+_sessions_lock = threading.Lock()
 
 
-# ============================================================
-# Danbooru provider
-# ============================================================
+def set_pool_size(size: int) -> None:
+    """Set the per-host connection pool size used by sessions created afterwards."""
+    global POOL_SIZE
+    POOL_SIZE = max(1, size)
 
 
-class DanbooruProvider(BooruProvider):
-    BASE = "https://danbooru.donmai.us"
+def get_session(
+    base: str,
+    auth: Optional[Tuple[str, str]] = None,
+    params: Optional[Dict[str, Any]] = None,
+) -> requests.Session:
+    """
+    Shared keep-alive session for a host.
+    Sessions are pooled per host and credentials, so every provider talking
+    to the same site reuses its TCP/TLS connections.
+    """
+    host = urlsplit(base).netloc
+    key = (host, auth, tuple(sorted((params or {}).items())))
+
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers.update({"User-Agent": USER_AGENT})
+            if auth:
+                session.auth = HTTPBasicAuth(*auth)
+            if params:
+                session.params.update(params)
+            _sessions[key] = session
+        return session
 
-    def __init__(self, api_user: Optional[str] = None, api_key: Optional[str] = None):
-        self.user = api_user
-        self.key = api_key
 
-    def fetch_posts(self, tags, post_id="random", page=1, limit=6):
-        if post_id == "random":
-            url = (
-                f"{self.BASE}/posts.json?"
-                f"limit={limit}&page={page}&tags=+{'+'.join(tags)}"
-            )
-        else:
-            url = f"{self.BASE}/posts/{post_id}.json"
+# ============================================================
+# Rate limiting
+# ============================================================
 
-        r = None
 
-        headers = {"User-Agent": "AGSBooruViewer/1.0 (ArchLinux; Hyprland)"}
+# Sustained requests per second allowed per API host; unknown hosts get the default
+RATE_LIMITS = {
+    "danbooru.donmai.us": 10.0,
+    "safebooru.donmai.us": 10.0,
+    "gelbooru.com": 5.0,
+}
+DEFAULT_RATE_LIMIT = 4.0
+RATE_LIMIT_DIR = BOORU_CACHE_DIR / "ratelimit"
+MAX_IN_FLIGHT = 4
+MAX_RETRIES = 4
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+RETRY_STATUSES = {429, 503}
 
-        try:
-            auth = (
-                HTTPBasicAuth(self.user, self.key) if self.user and self.key else None
+
+class RateLimiter:
+    """
+    Token bucket for one host, shared by every booru.py process.
+    The bucket lives in a small JSON file updated under flock, so the CLI,
+    prefetch jobs and the service all draw from the same budget. A 429/503
+    halves the rate and blocks the host for the backoff delay; the rate then
+    climbs back to the ceiling over RECOVERY_SECONDS of quiet.
+    """
+
+    RECOVERY_SECONDS = 30.0
+
+    def __init__(self, host: str, rate: float):
+        self.host = host
+        self.ceiling = rate
+        self.burst = max(1.0, rate)
+        self.path = RATE_LIMIT_DIR / f"{host.replace(':', '_')}.json"
+        # Caps concurrent requests from this process, whatever the token budget
+        self.in_flight = threading.BoundedSemaphore(MAX_IN_FLIGHT)
+
+    @contextmanager
+    def _state(self) -> Iterator[Dict[str, float]]:
+        """Locked read-modify-write of the bucket, refilled up to now."""
+        with locked_json_file(self.path, {}) as state:
+            now = time.time()
+            elapsed = max(0.0, now - state.get("updated", now))
+            rate = min(
+                self.ceiling,
+                state.get("rate", self.ceiling)
+                + elapsed * self.ceiling / self.RECOVERY_SECONDS,
             )
-            r = requests.get(url, auth=auth, headers=headers, timeout=15)
-            r.raise_for_status()
-        except requests.exceptions.Timeout:
-            raise Exception(f"Request timeout after 15 seconds for {self.BASE}")
-        except requests.exceptions.ConnectionError as e:
-            raise Exception(
-                f"Connection error: Unable to reach {self.BASE}. Check your internet connection."
+            state.update(
+                rate=rate,
+                tokens=min(
+                    self.burst, state.get("tokens", self.burst) + elapsed * rate
+                ),
+                blocked_until=state.get("blocked_until", 0.0),
+                updated=now,
+            )
+            yield state
+
+    def acquire(self) -> None:
+        """Block until the host may receive one more request."""
+        while True:
+            with self._state() as state:
+                wait = state["blocked_until"] - state["updated"]
+                if wait <= 0:
+                    if state["tokens"] >= 1:
+                        state["tokens"] -= 1
+                        return
+                    wait = (1 - state["tokens"]) / state["rate"]
+            time.sleep(wait)
+
+    def penalize(self, delay: float) -> None:
+        """The host pushed back: slow down and hold off for `delay` seconds."""
+        with self._state() as state:
+            state["rate"] = max(self.ceiling / 16, state["rate"] / 2)
+            state["tokens"] = 0.0
+            state["blocked_until"] = max(
+                state["blocked_until"], state["updated"] + delay
             )
-        except requests.exceptions.HTTPError as e:
-            if r and r.status_code == 401:
-                raise Exception(
-                    f"Authentication failed (401): Invalid API credentials for Danbooru"
-                )
-            elif r and r.status_code == 404:
-                raise Exception(
-                    f"Post not found (404): Post ID {post_id} does not exist"
-                )
-            else:
-                raise Exception(
-                    f"HTTP error {r.status_code}: {r.reason}" if r else str(e)
-                )
-        except Exception as e:
-            raise Exception(f"Unexpected error: {str(e)}")
-
-        try:
-            posts = r.json()
-        except json.JSONDecodeError:
-            raise Exception(f"Invalid JSON response from {self.BASE}")
 
-        if not isinstance(posts, list):
-            posts = [posts]
 
-        result = []
-        for post in posts:
-            variants = post.get("media_asset", {}).get("variants", [])
-            preview = variants[1]["url"] if len(variants) > 1 else None
+_rate_limiters: Dict[str, RateLimiter] = {}
+_rate_limiters_lock = threading.Lock()
 
-            data = {
-                "id": post.get("id"),
-                "url": post.get("file_url"),
-                "preview": preview,
-                "width": post.get("image_width"),
-                "height": post.get("image_height"),
-                "extension": post.get("file_ext"),
-                "tags": post.get("tag_string", "").split(),
-            }
 
-            if all(data.values()):
-                result.append(data)
+def get_rate_limiter(url: str) -> RateLimiter:
+    host = urlsplit(url).netloc
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(host)
+        if limiter is None:
+            limiter = RateLimiter(host, RATE_LIMITS.get(host, DEFAULT_RATE_LIMIT))
+            _rate_limiters[host] = limiter
+        return limiter
 
-        return result
 
-    def fetch_tags(self, tag, limit=10):
-        url = f"{self.BASE}/tags.json"
-        params = {
-            "search[name_matches]": f"*{tag}*",
-            "search[order]": "count",
-            "limit": limit,
-        }
-        headers = {"User-Agent": "AGSBooruViewer/1.0 (ArchLinux; Hyprland)"}
+def retry_delay(response: requests.Response, attempt: int) -> float:
+    """Server's Retry-After when given, else capped exponential backoff with full jitter."""
+    retry_after = response.headers.get("Retry-After")
+    if retry_after:
         try:
-            auth = (
-                HTTPBasicAuth(self.user, self.key) if self.user and self.key else None
-            )
-            r = requests.get(url, params=params, auth=auth, headers=headers, timeout=15)
-            r.raise_for_status()
-        except requests.exceptions.Timeout:
-            raise Exception(f"Request timeout after 15 seconds for {self.BASE}")
-        except requests.exceptions.ConnectionError:
-            raise Exception(
-                f"Connection error: Unable to reach {self.BASE}. Check your internet connection."
-            )
-        except requests.exceptions.HTTPError as e:
-            if e.response.status_code == 401:
-                raise Exception(
-                    f"Authentication failed (401): Invalid API credentials for Danbooru"
-                )
-            else:
-                raise Exception(
-                    f"HTTP error {e.response.status_code}: {e.response.reason}"
-                )
-        except Exception as e:
-            raise Exception(f"Unexpected error: {str(e)}")
-
+            return min(BACKOFF_MAX, max(0.0, float(retry_after)))
+        except ValueError:
+            pass
         try:
-            return [t["name"] for t in r.json()]
-        except (json.JSONDecodeError, KeyError, TypeError) as e:
-            raise Exception(f"Failed to parse tag response: {str(e)}")
+            moment = parsedate_to_datetime(retry_after).timestamp()
+            return min(BACKOFF_MAX, max(0.0, moment - time.time()))
+        except (TypeError, ValueError):
+            pass
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
 
 
 # ============================================================
-# Gelbooru provider
+# Response cache
 # ============================================================
 
 
-class GelbooruProvider(BooruProvider):
-    BASE = "https://gelbooru.com/index.php"
+RESPONSE_CACHE_TTLS = {
+    "posts": 5 * 60,
+    "post": 24 * 60 * 60,
+    "tags": 60 * 60,
+    # Random draws must differ every time, never cache them
+    "random": 0,
+}
+RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+RESPONSE_CACHE_ENABLED = True
 
-    def __init__(self, api_user: Optional[str] = None, api_key: Optional[str] = None):
-        self.user = api_user
-        self.key = api_key
 
-    def fetch_posts(self, tags, post_id="random", page=1, limit=6):
-        params = {
-            "page": "dapi",
-            "s": "post",
-            "q": "index",
-            "json": "1",
-            "limit": limit,
-            "user_id": self.user,
-            "api_key": self.key,
-        }
-        headers = {"User-Agent": "AGSBooruViewer/1.0 (ArchLinux; Hyprland)"}
-        if post_id != "random":
-            params["id"] = post_id
-        else:
-            params["pid"] = max(0, page - 1)
-            params["tags"] = " ".join(tags)
+def normalize_tags(tags: List[str]) -> List[str]:
+    """Canonical tag list for cache keys: trimmed, lowercased, deduplicated, sorted."""
+    return sorted({t.strip().lower() for t in tags if t and t.strip()})
 
-        try:
-            r = requests.get(self.BASE, params=params, headers=headers, timeout=15)
-            r.raise_for_status()
-        except requests.exceptions.Timeout:
-            raise Exception(f"Request timeout after 15 seconds for Gelbooru")
-        except requests.exceptions.ConnectionError:
-            raise Exception(
-                f"Connection error: Unable to reach Gelbooru. Check your internet connection."
-            )
-        except requests.exceptions.HTTPError as e:
-            if e.response.status_code == 401:
-                raise Exception(
-                    f"Authentication failed (401): Invalid API credentials for Gelbooru"
-                )
-            else:
-                raise Exception(
-                    f"HTTP error {e.response.status_code}: {e.response.reason}"
-                )
-        except Exception as e:
-            raise Exception(f"Unexpected error: {str(e)}")
 
-        try:
-            posts = r.json().get("post", [])
-        except (json.JSONDecodeError, AttributeError) as e:
-            raise Exception(f"Invalid JSON response from Gelbooru: {str(e)}")
+class ResponseCache:
+    """
+    On-disk JSON response cache.
+    Entries keep the site's ETag/Last-Modified validators for conditional
+    revalidation; file mtimes track recency for LRU eviction.
+    """
 
-        if isinstance(posts, dict):
-            posts = [posts]
+    def __init__(self, root: Optional[Path] = None, max_bytes: Optional[int] = None):
+        self.root = root or BOORU_CACHE_DIR / "responses"
+        self.max_bytes = max_bytes or RESPONSE_CACHE_MAX_BYTES
+        self._lock = threading.Lock()
 
-        result = []
-        for post in posts:
-            url = post.get("file_url")
-            data = {
-                "id": post.get("id"),
-                "url": url,
-                "preview": post.get("preview_url"),
-                "width": post.get("width"),
-                "height": post.get("height"),
-                "extension": url.split(".")[-1] if url else None,
-                "tags": str(post.get("tags", "")).split(),
-            }
+    @staticmethod
+    def key(*parts: Any) -> str:
+        raw = json.dumps(parts, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
 
-            if all(data.values()):
-                result.append(data)
+    def _path(self, key: str) -> Path:
+        return self.root / f"{key}.json"
 
-        return result or None
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        path = self._path(key)
+        try:
+            entry = json.loads(path.read_text(encoding="utf-8"))
+            os.utime(path)
+        except (OSError, json.JSONDecodeError):
+            return None
+        return entry if isinstance(entry, dict) and "body" in entry else None
 
-    def fetch_tags(self, tag, limit=10):
-        params = {
-            "page": "dapi",
-            "s": "tag",
-            "q": "index",
-            "json": "1",
-            "name_pattern": f"%{tag}%",
-            "limit": 1000,
-            "user_id": self.user,
-            "api_key": self.key,
+    def put(
+        self,
+        key: str,
+        body: Any,
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+    ) -> None:
+        entry = {
+            "stored_at": time.time(),
+            "etag": etag,
+            "last_modified": last_modified,
+            "body": body,
         }
-        headers = {"User-Agent": "AGSBooruViewer/1.0 (ArchLinux; Hyprland)"}
         try:
-            r = requests.get(self.BASE, params=params, headers=headers, timeout=15)
-            r.raise_for_status()
-        except requests.exceptions.Timeout:
-            raise Exception(f"Request timeout after 15 seconds for Gelbooru")
-        except requests.exceptions.ConnectionError:
-            raise Exception(
-                f"Connection error: Unable to reach Gelbooru. Check your internet connection."
-            )
-        except requests.exceptions.HTTPError as e:
-            raise Exception(f"HTTP error {e.response.status_code}: {e.response.reason}")
-        except Exception as e:
-            raise Exception(f"Unexpected error: {str(e)}")
+            atomic_write_json(self._path(key), entry)
+        except OSError:
+            return
+        self.evict()
 
-        try:
-            tags = r.json().get("tag", []) or []
-            tags.sort(key=lambda t: int(t.get("post_count", 0)), reverse=True)
-            return [t["name"] for t in tags[:limit] if t.get("name")]
-        except (json.JSONDecodeError, KeyError, TypeError) as e:
-            raise Exception(f"Failed to parse tag response: {str(e)}")
+    def refresh(self, key: str, entry: Dict[str, Any]) -> None:
+        """Mark a revalidated (304) entry as fresh again."""
+        self.put(key, entry["body"], entry.get("etag"), entry.get("last_modified"))
 
+    def evict(self) -> None:
+        """Drop least recently used entries until the cache fits in max_bytes."""
+        with self._lock:
+            try:
+                files = [
+                    (e.stat().st_mtime, e.stat().st_size, e.path)
+                    for e in os.scandir(self.root)
+                    if e.name.endswith(".json")
+                ]
+            except OSError:
+                return
+
+            total = sum(size for _, size, _ in files)
+            if total <= self.max_bytes:
+                return
+
+            files.sort()
+            for _, size, path in files:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.unlink(path)
+                    total -= size
+                except OSError:
+                    pass
+
+
+_response_cache: Optional[ResponseCache] = None
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    global _response_cache
+    if not RESPONSE_CACHE_ENABLED:
+        return None
+    if _response_cache is None:
+        _response_cache = ResponseCache()
+    return _response_cache
+
+
+def set_response_cache_enabled(enabled: bool) -> None:
+    global RESPONSE_CACHE_ENABLED
+    RESPONSE_CACHE_ENABLED = enabled
 
-import requests
-from typing import List, Optional, Dict, Any
 
 # ============================================================
-# Safebooru provider
+# Tag index
 # ============================================================
 
 
-class SafebooruProvider(BooruProvider):
+TAG_INDEX_QUERY_TTL = 7 * 24 * 60 * 60
+TAG_INDEX_MAX_QUERIES = 2000
+TAG_INDEX_PENDING_MAX_BYTES = 256 * 1024
+
+
+class TagIndex:
     """
-    Safebooru (Danbooru-based) provider.
-    Uses the same API schema as Danbooru, but without authentication.
-    Optionally accepts API credentials (currently unused).
+    Persistent per-provider tag index (names and post counts) answering
+    autocomplete lookups locally.
+
+    Counts come from tag responses; names seen on posts are appended to a
+    small pending log, read on load and folded into the snapshot on save or
+    once it passes TAG_INDEX_PENDING_MAX_BYTES, so browsing never pays for
+    rewriting the index. Remote queries are recorded
+    with whether they returned every match, which lets any longer query
+    containing a complete one be answered without the network.
     """
 
-    BASE = "https://safebooru.donmai.us"
-    # EXCLUDE_TAGS = ["-animated"]
+    def __init__(self, api: str, root: Optional[Path] = None):
+        root = root or BOORU_CACHE_DIR / "tags"
+        self.path = root / f"{api}.json"
+        self.pending_path = root / f"{api}.pending"
+        self.counts: Dict[str, int] = {}
+        self.queries: Dict[str, List[Any]] = {}
+        self._names: List[str] = []
+        self._loaded = False
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    def _load(self) -> None:
+        if self._loaded:
+            return
+        self._loaded = True
 
-    def __init__(self, api_user: Optional[str] = None, api_key: Optional[str] = None):
-        # Safebooru doesn't require authentication, but accepts it for compatibility
-        self.user = api_user
-        self.key = api_key
+        try:
+            snapshot = json.loads(self.path.read_text(encoding="utf-8"))
+            self.counts = snapshot.get("tags", {})
+            self.queries = snapshot.get("queries", {})
+        except (OSError, json.JSONDecodeError, AttributeError):
+            pass
+
+        self._merge_names(log_records(self.pending_path))
+
+    def _merge_names(self, records: Iterable[Any]) -> None:
+        """Add the names of pending-log records, post counts unknown."""
+        for names in records:
+            for name in names:
+                self.counts.setdefault(name, 0)
+            self._dirty = True
+        self._names = sorted(self.counts)
+
+    def observe(self, tag_lists: List[List[str]]) -> None:
+        """Record tag names seen on posts (post counts unknown)."""
+        names = sorted({name for tags in tag_lists for name in tags})
+        if not names:
+            return
 
-    def fetch_posts(
-        self,
-        tags: List[str],
-        post_id: str = "random",
-        page: int = 1,
-        limit: int = 6,
-    ) -> Optional[List[Dict[str, Any]]]:
-
-        if post_id == "random":
-            url = (
-                f"{self.BASE}/posts.json?"
-                f"limit={limit}&page={page}&tags=+{'+'.join(tags)}"
+        with self._lock:
+            if self._loaded:
+                new = [name for name in names if name not in self.counts]
+                if not new:
+                    return
+                for name in new:
+                    self.counts[name] = 0
+                self._names = sorted(self.counts)
+            try:
+                self.pending_path.parent.mkdir(parents=True, exist_ok=True)
+                with open(self.pending_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(names, separators=(",", ":")) + "\n")
+            except OSError:
+                pass
+
+    def add(self, pairs: List[Tuple[str, int]], query: str, complete: bool) -> None:
+        """Merge a remote tag response and remember the query it answered."""
+        with self._lock:
+            self._load()
+            for name, count in pairs:
+                self.counts[name] = max(count, self.counts.get(name, 0))
+            self.queries[query] = [time.time(), complete]
+            if len(self.queries) > TAG_INDEX_MAX_QUERIES:
+                oldest = sorted(self.queries, key=lambda q: self.queries[q][0])
+                for stale in oldest[: len(self.queries) - TAG_INDEX_MAX_QUERIES]:
+                    del self.queries[stale]
+            self._names = sorted(self.counts)
+            self._dirty = True
+
+    def covers(self, query: str) -> bool:
+        """Whether the local index already holds the full answer for query."""
+        with self._lock:
+            self._load()
+            now = time.time()
+            for known, (queried_at, complete) in self.queries.items():
+                if now - queried_at > TAG_INDEX_QUERY_TTL:
+                    continue
+                if known == query or (complete and known in query):
+                    return True
+            return False
+
+    def lookup(self, query: str, limit: int) -> List[Tuple[str, int]]:
+        """Tags containing query, ranked by post count (prefix matches win ties)."""
+        with self._lock:
+            self._load()
+            start = bisect.bisect_left(self._names, query)
+            end = bisect.bisect_left(self._names, query + "\uffff")
+            prefix = self._names[start:end]
+            substring = [
+                name
+                for name in itertools.chain(self._names[:start], self._names[end:])
+                if query in name
+            ]
+
+            ranked = heapq.nsmallest(
+                limit,
+                itertools.chain(
+                    ((-self.counts[name], 0, name) for name in prefix),
+                    ((-self.counts[name], 1, name) for name in substring),
+                ),
             )
+            return [(name, -count) for count, _, name in ranked]
+
+    def compact_if_large(self) -> None:
+        """Fold the pending log once it grows past TAG_INDEX_PENDING_MAX_BYTES."""
+        try:
+            if self.pending_path.stat().st_size > TAG_INDEX_PENDING_MAX_BYTES:
+                self.save()
+        except OSError:
+            pass
+
+    def save(self) -> None:
+        with self._lock:
+            self._load()
+            with taken_log(self.pending_path) as records:
+                if records is not None:
+                    self._merge_names(records)
+                if not self._dirty:
+                    return
+                try:
+                    atomic_write_json(
+                        self.path, {"tags": self.counts, "queries": self.queries}
+                    )
+                    self._dirty = False
+                except OSError:
+                    pass
+
+
+_tag_indexes: Dict[str, TagIndex] = {}
+
+
+def get_tag_index(api: str) -> TagIndex:
+    return _tag_indexes.setdefault(api, TagIndex(api))
+
+
+# ============================================================
+# Related tags
+# ============================================================
+
+
+RELATED_HALF_LIFE = 30 * 24 * 60 * 60
+RELATED_MAX_TAGS = 20000
+RELATED_MAX_PAIRS = 100000
+RELATED_SEEN_POSTS = 5000
+RELATED_PENDING_MAX_BYTES = 1024 * 1024
+
+
+class CooccurrenceTable:
+    """
+    Per-provider tag co-occurrence counts built from fetched posts, answering
+    related-tag queries without the network.
+
+    Tags are interned to integer ids; each tag keeps a sparse row of
+    {other id: count}. Posts are appended to a pending log as they are seen
+    and folded in by the next related() or save(), each post id counted once. Counts decay
+    with RELATED_HALF_LIFE, and the weakest tags and pairs are pruned to stay
+    within RELATED_MAX_TAGS / RELATED_MAX_PAIRS.
+    """
+
+    def __init__(self, api: str, root: Optional[Path] = None):
+        root = root or BOORU_CACHE_DIR / "related"
+        self.path = root / f"{api}.json"
+        self.pending_path = root / f"{api}.pending"
+        self.names: List[str] = []
+        self.ids: Dict[str, int] = {}
+        self.counts: List[float] = []
+        self.rows: List[Dict[int, float]] = []
+        self.seen: Dict[int, None] = {}
+        self.decayed_at = time.time()
+        self._loaded = False
+        self._stamp: Optional[Tuple[int, int]] = None
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    def _intern(self, name: str) -> int:
+        tag_id = self.ids.get(name)
+        if tag_id is None:
+            tag_id = self.ids[name] = len(self.names)
+            self.names.append(name)
+            self.counts.append(0.0)
+            self.rows.append({})
+        return tag_id
+
+    def _count(self, post_id: Any, tags: List[str]) -> None:
+        if post_id in self.seen:
+            return
+        self.seen[post_id] = None
+        ids = sorted({self._intern(name) for name in tags})
+        for i, a in enumerate(ids):
+            self.counts[a] += 1
+            row = self.rows[a]
+            for b in ids[i + 1 :]:
+                row[b] = row.get(b, 0.0) + 1
+                self.rows[b][a] = self.rows[b].get(a, 0.0) + 1
+
+    def _snapshot_stamp(self) -> Optional[Tuple[int, int]]:
+        try:
+            st = os.stat(self.path)
+            return (st.st_mtime_ns, st.st_ino)
+        except OSError:
+            return None
+
+    def _load(self) -> None:
+        """Read the snapshot, again whenever another process has replaced it."""
+        stamp = self._snapshot_stamp()
+        # Folded-but-unsaved counts live only in memory: never drop them
+        if self._loaded and (self._dirty or stamp == self._stamp):
+            return
+        self._loaded = True
+        self._stamp = stamp
+
+        try:
+            snapshot = json.loads(self.path.read_text(encoding="utf-8"))
+            self.names = snapshot["names"]
+            self.ids = {name: i for i, name in enumerate(self.names)}
+            self.counts = snapshot["counts"]
+            self.rows = [{} for _ in self.names]
+            pairs = snapshot["pairs"]
+            for k in range(0, len(pairs), 3):
+                a, b, count = pairs[k : k + 3]
+                self.rows[a][b] = self.rows[b][a] = count
+            self.seen = dict.fromkeys(snapshot.get("seen", []))
+            self.decayed_at = snapshot.get("decayed_at", time.time())
+        except (OSError, json.JSONDecodeError, KeyError, IndexError, ValueError):
+            self.names, self.ids, self.counts, self.rows = [], {}, [], []
+            self.seen = {}
+
+    def _fold_pending(self) -> None:
+        """Count the posts logged since the last fold (caller holds _lock)."""
+        with taken_log(self.pending_path) as records:
+            if records is None:
+                return
+            for posts in records:
+                for post_id, tags in posts:
+                    self._count(post_id, tags)
+            self._dirty = True
+
+    def observe(self, posts: List[Dict[str, Any]]) -> None:
+        """Queue the tag lists of fetched posts for counting."""
+        entries = [
+            [post["id"], post["tags"]]
+            for post in posts
+            if post.get("tags") and post["id"] not in self.seen
+        ]
+        if not entries:
+            return
+
+        with self._lock:
+            try:
+                self.pending_path.parent.mkdir(parents=True, exist_ok=True)
+                with open(self.pending_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(entries, separators=(",", ":")) + "\n")
+            except OSError:
+                pass
+
+    def compact_if_large(self) -> None:
+        """Fold the pending log once it grows past RELATED_PENDING_MAX_BYTES."""
+        try:
+            if self.pending_path.stat().st_size > RELATED_PENDING_MAX_BYTES:
+                self.save()
+        except OSError:
+            pass
+
+    def related(self, tags: List[str], limit: int) -> List[Tuple[str, float]]:
+        """
+        Tags most associated with every tag in `tags`, best first.
+        A candidate scores the lowest of its cosine similarities with the
+        query tags, so it has to go with all of them. Metatags and negated
+        tags in the query are ignored.
+        """
+        with self._lock:
+            self._load()
+            self._fold_pending()
+            folded = self._dirty
+        if folded:
+            # The pending log is gone once folded, persist what it held
+            self.save()
+
+        with self._lock:
+            query = [
+                self.ids[name]
+                for name in {t.strip().lower() for t in tags}
+                if name in self.ids and ":" not in name and not name.startswith("-")
+            ]
+            if not query:
+                return []
+
+            rarest = min(query, key=lambda tag_id: len(self.rows[tag_id]))
+            scores = []
+            for candidate in self.rows[rarest]:
+                if candidate in query:
+                    continue
+                score = min(
+                    self.rows[q].get(candidate, 0.0)
+                    / math.sqrt(self.counts[q] * self.counts[candidate])
+                    for q in query
+                )
+                if score > 0:
+                    scores.append((score, self.names[candidate]))
+
+            return [
+                (name, round(score, 4)) for score, name in heapq.nlargest(limit, scores)
+            ]
+
+    def _decay_and_prune(self) -> None:
+        now = time.time()
+        factor = 0.5 ** ((now - self.decayed_at) / RELATED_HALF_LIFE)
+        self.decayed_at = now
+
+        keep = [i for i, count in enumerate(self.counts) if count * factor >= 0.5]
+        if len(keep) > RELATED_MAX_TAGS:
+            keep = heapq.nlargest(RELATED_MAX_TAGS, keep, key=lambda i: self.counts[i])
+            keep.sort()
+
+        pairs = [
+            (count * factor, a, b)
+            for a in keep
+            for b, count in self.rows[a].items()
+            if a < b and count * factor >= 0.5
+        ]
+        if len(pairs) > RELATED_MAX_PAIRS:
+            cutoff = sorted((count for count, _, _ in pairs), reverse=True)[
+                RELATED_MAX_PAIRS - 1
+            ]
+            pairs = [pair for pair in pairs if pair[0] >= cutoff][:RELATED_MAX_PAIRS]
+
+        # Renumber the surviving tags densely
+        remap = {old: new for new, old in enumerate(keep)}
+        self.names = [self.names[i] for i in keep]
+        self.ids = {name: i for i, name in enumerate(self.names)}
+        self.counts = [self.counts[i] * factor for i in keep]
+        self.rows = [{} for _ in keep]
+        for count, a, b in pairs:
+            if b in remap:
+                self.rows[remap[a]][remap[b]] = count
+                self.rows[remap[b]][remap[a]] = count
+
+        seen = list(self.seen)[-RELATED_SEEN_POSTS:]
+        self.seen = dict.fromkeys(seen)
+
+    def save(self) -> None:
+        """Fold pending posts, decay, prune and write the snapshot."""
+        with self._lock:
+            self._load()
+            self._fold_pending()
+            if not self._dirty:
+                return
+            self._decay_and_prune()
+            pairs = [
+                value
+                for a, row in enumerate(self.rows)
+                for b, count in row.items()
+                if a < b
+                for value in (a, b, round(count, 2))
+            ]
+            try:
+                atomic_write_json(
+                    self.path,
+                    {
+                        "names": self.names,
+                        "counts": [round(c, 2) for c in self.counts],
+                        "pairs": pairs,
+                        "seen": list(self.seen),
+                        "decayed_at": self.decayed_at,
+                    },
+                )
+                self._stamp = self._snapshot_stamp()
+                self._dirty = False
+            except OSError:
+                pass
+
+
+_cooccurrence_tables: Dict[str, CooccurrenceTable] = {}
+
+
+def get_cooccurrence_table(api: str) -> CooccurrenceTable:
+    return _cooccurrence_tables.setdefault(api, CooccurrenceTable(api))
+
+
+# ============================================================
+# Media variants
+# ============================================================
+
+
+# (max width, max height) of the widget showing a post, None for unbounded
+MaxSize = Optional[Tuple[Optional[int], Optional[int]]]
+
+# Resized variants are stills, animations and videos keep their original file
+RESIZABLE_EXTENSIONS = {"jpg", "jpeg", "png", "webp", "avif"}
+
+
+def pick_variant(variants: List[Dict[str, Any]], max_size: MaxSize) -> Dict[str, Any]:
+    """
+    Smallest variant covering `max_size`, the largest one when none does.
+    Variants are {type, url, width, height, extension} dicts; ones missing a
+    url or dimensions are ignored.
+    """
+    usable = [v for v in variants if v["url"] and v["width"] and v["height"]]
+    usable.sort(key=lambda v: int(v["width"]) * int(v["height"]))
+    max_width, max_height = max_size or (None, None)
+    for variant in usable:
+        if int(variant["width"]) >= (max_width or 0) and int(variant["height"]) >= (
+            max_height or 0
+        ):
+            return variant
+    return usable[-1]
+
+
+def apply_variant(
+    data: Dict[str, Any], variants: List[Dict[str, Any]], max_size: MaxSize
+) -> Dict[str, Any]:
+    """
+    Point a normalized post at the variant fitting `max_size`.
+    When that is not the original, its md5 no longer describes the file at
+    url, so it moves to file_md5.
+    """
+    if not max_size or str(data["extension"]).lower() not in RESIZABLE_EXTENSIONS:
+        return data
+    variant = pick_variant(
+        variants
+        + [
+            {
+                "type": "original",
+                "url": data["url"],
+                "width": data["width"],
+                "height": data["height"],
+                "extension": data["extension"],
+            }
+        ],
+        max_size,
+    )
+    data.update(
+        url=variant["url"],
+        width=variant["width"],
+        height=variant["height"],
+        extension=variant["extension"],
+        variant=variant["type"],
+    )
+    if variant["type"] != "original" and "md5" in data:
+        data["file_md5"] = data.pop("md5")
+    return data
+
+
+# ============================================================
+# Incremental JSON
+# ============================================================
+
+
+JSON_CHUNK_SIZE = 16 * 1024
+_json_decoder = json.JSONDecoder()
+# Characters that may continue a number; "" is the end of the buffer
+_NUMBER_TAIL = set("0123456789.eE+-") | {""}
+
+
+class JsonItemReader:
+    """
+    Reads a JSON document from text chunks and yields the elements of its
+    post array as each one completes, so callers can start on the first
+    posts while the rest of the page is still downloading.
+
+    The array is the document itself, or its `items_key` member when the
+    document is an object; a lone object in that place counts as a
+    one-element array. `body` holds the whole document once read.
+    """
+
+    def __init__(self, chunks: Iterator[str], items_key: Optional[str] = None):
+        self.chunks = chunks
+        self.items_key = items_key
+        self.body: Any = None
+        self._found: Any = None
+        self._buf = ""
+        self._pos = 0
+
+    def _more(self) -> bool:
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            return False
+        self._buf = self._buf[self._pos :] + chunk
+        self._pos = 0
+        return True
+
+    def _peek(self) -> Optional[str]:
+        """Next non-whitespace character, without consuming it."""
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in " \t\r\n":
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._more():
+                return None
+
+    def _expect(self, char: str) -> None:
+        if self._peek() != char:
+            raise ValueError(f"expected {char!r}")
+        self._pos += 1
+
+    def _value(self) -> Any:
+        self._peek()
+        while True:
+            try:
+                value, end = _json_decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                if not self._more():
+                    raise
+                continue
+            # raw_decode stops a number cut by the chunk boundary early ("1."
+            # reads as 1), so only trust one followed by a delimiter
+            if (
+                isinstance(value, (int, float))
+                and self._buf[end : end + 1] in _NUMBER_TAIL
+                and self._more()
+            ):
+                continue
+            self._pos = end
+            return value
+
+    def _array(self) -> Iterator[Any]:
+        self._expect("[")
+        while True:
+            char = self._peek()
+            if char == "]":
+                self._pos += 1
+                return
+            if char == ",":
+                self._pos += 1
+                continue
+            yield self._value()
+
+    def _items(self) -> Iterator[Any]:
+        """Elements of the value at the current position (array or lone item)."""
+        items: List[Any] = []
+        if self._peek() == "[":
+            for item in self._array():
+                items.append(item)
+                yield item
+            self._found = items
         else:
-            url = f"{self.BASE}/posts/{post_id}.json"
-        headers = {"User-Agent": "AGSBooruViewer/1.0 (ArchLinux; Hyprland)"}
+            item = self._value()
+            self._found = item
+            yield item
+
+    def __iter__(self) -> Iterator[Any]:
+        if self.items_key is None or self._peek() != "{":
+            yield from self._items()
+            self.body = self._found
+            return
+
+        self._expect("{")
+        self.body = {}
+        while True:
+            char = self._peek()
+            if char == "}":
+                self._pos += 1
+                return
+            if char == ",":
+                self._pos += 1
+                continue
+            key = self._value()
+            self._expect(":")
+            if key == self.items_key:
+                yield from self._items()
+                self.body[key] = self._found
+            else:
+                self.body[key] = self._value()
+
+
+def json_items(body: Any, items_key: Optional[str] = None) -> List[Any]:
+    """Elements of an already parsed document, as JsonItemReader yields them."""
+    if items_key is not None and isinstance(body, dict):
+        body = body.get(items_key, [])
+    return body if isinstance(body, list) else [body]
+
+
+def iter_text(r: requests.Response) -> Iterator[str]:
+    """Decoded body chunks of a streamed response (JSON is UTF-8)."""
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    for chunk in r.iter_content(chunk_size=JSON_CHUNK_SIZE):
+        yield decoder.decode(chunk)
+    yield decoder.decode(b"", final=True)
+
+
+# ============================================================
+# Provider interface
+# ============================================================
+
+
+class BooruProvider(ABC):
+    API = ""
+    NAME = "Booru"
+    BASE = ""
+    IDS_CHUNK = 100
+    RANDOM_TAG = "order:random"
+
+    def __init__(self, api_user: Optional[str] = None, api_key: Optional[str] = None):
+        self.user = api_user
+        self.key = api_key
+        self.session = self._create_session()
+
+    def _create_session(self) -> requests.Session:
+        return get_session(self.BASE)
+
+    def _get(
+        self,
+        url: str,
+        params: Optional[Dict[str, Any]] = None,
+        not_found: Optional[str] = None,
+        headers: Optional[Dict[str, str]] = None,
+        stream: bool = False,
+    ) -> requests.Response:
+        """
+        GET through the pooled session, turning failures into readable errors.
+        Requests are paced by the host's rate limiter and retried with backoff
+        when the site answers 429/503. With `stream`, the body is left unread.
+        """
+        limiter = get_rate_limiter(url)
         try:
-            r = requests.get(url, headers=headers, timeout=15)
+            for attempt in range(MAX_RETRIES + 1):
+                limiter.acquire()
+                with limiter.in_flight:
+                    r = self.session.get(
+                        url,
+                        params=params,
+                        headers=headers,
+                        timeout=REQUEST_TIMEOUT,
+                        stream=stream,
+                    )
+                if r.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                    break
+                r.close()
+                limiter.penalize(retry_delay(r, attempt))
             r.raise_for_status()
         except requests.exceptions.Timeout:
-            raise Exception(f"Request timeout after 15 seconds for Safebooru")
+            raise Exception(
+                f"Request timeout after {REQUEST_TIMEOUT} seconds for {self.NAME}"
+            )
         except requests.exceptions.ConnectionError:
             raise Exception(
-                f"Connection error: Unable to reach Safebooru. Check your internet connection."
+                f"Connection error: Unable to reach {self.NAME}. Check your internet connection."
             )
         except requests.exceptions.HTTPError as e:
-            if e.response.status_code == 404:
+            status = e.response.status_code
+            if status == 401:
                 raise Exception(
-                    f"Post not found (404): Post ID {post_id} does not exist"
+                    f"Authentication failed (401): Invalid API credentials for {self.NAME}"
                 )
+            elif status == 404 and not_found:
+                raise Exception(not_found)
             else:
-                raise Exception(
-                    f"HTTP error {e.response.status_code}: {e.response.reason}"
-                )
+                raise Exception(f"HTTP error {status}: {e.response.reason}")
         except Exception as e:
             raise Exception(f"Unexpected error: {str(e)}")
 
+        return r
+
+    def _cache_lookup(
+        self, kind: str, key_parts: Tuple[Any, ...]
+    ) -> Tuple[Optional[ResponseCache], Optional[str], Any, Dict[str, str]]:
+        """
+        Cache, key and entry for a request, plus the revalidation headers.
+        The entry is None unless it can be used: fresh, or stale with
+        validators (then the headers are non-empty).
+        """
+        cache = get_response_cache() if RESPONSE_CACHE_TTLS[kind] else None
+        key = cache.key(self.NAME, self.user, kind, *key_parts) if cache else None
+        entry = cache.get(key) if cache else None
+
+        headers: Dict[str, str] = {}
+        if entry:
+            if time.time() - entry.get("stored_at", 0) < RESPONSE_CACHE_TTLS[kind]:
+                return cache, key, entry, headers
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        return cache, key, entry if headers else None, headers
+
+    def _get_json(
+        self,
+        url: str,
+        params: Optional[Dict[str, Any]] = None,
+        kind: str = "posts",
+        key_parts: Tuple[Any, ...] = (),
+        not_found: Optional[str] = None,
+    ) -> Any:
+        """
+        GET a JSON document through the response cache.
+        Fresh entries are served from disk; stale ones are revalidated with
+        If-None-Match/If-Modified-Since when the site sent validators.
+        """
+        cache, key, entry, headers = self._cache_lookup(kind, key_parts)
+        if entry and not headers:
+            return entry["body"]
+
+        r = self._get(url, params=params, not_found=not_found, headers=headers)
+
+        if r.status_code == 304 and entry:
+            cache.refresh(key, entry)
+            return entry["body"]
+
         try:
-            posts = r.json()
+            body = r.json()
         except json.JSONDecodeError:
-            raise Exception(f"Invalid JSON response from Safebooru")
+            raise Exception(f"Invalid JSON response from {self.NAME}")
+
+        if cache:
+            cache.put(key, body, r.headers.get("ETag"), r.headers.get("Last-Modified"))
+        return body
+
+    def _stream_json(
+        self,
+        url: str,
+        params: Optional[Dict[str, Any]] = None,
+        kind: str = "posts",
+        key_parts: Tuple[Any, ...] = (),
+        not_found: Optional[str] = None,
+        items_key: Optional[str] = None,
+    ) -> Iterator[Any]:
+        """
+        _get_json for post listings: yields the posts (see JsonItemReader)
+        as they arrive over the wire instead of after the whole body is read.
+        """
+        cache, key, entry, headers = self._cache_lookup(kind, key_parts)
+        if entry and not headers:
+            yield from json_items(entry["body"], items_key)
+            return
+
+        r = self._get(
+            url, params=params, not_found=not_found, headers=headers, stream=True
+        )
+        with r:
+            if r.status_code == 304 and entry:
+                cache.refresh(key, entry)
+                yield from json_items(entry["body"], items_key)
+                return
 
-        if not isinstance(posts, list):
-            posts = [posts]
+            reader = JsonItemReader(iter_text(r), items_key)
+            try:
+                yield from reader
+            except (ValueError, requests.exceptions.RequestException):
+                raise Exception(f"Invalid JSON response from {self.NAME}")
 
-        result = []
-        for post in posts:
-            variants = post.get("media_asset", {}).get("variants", [])
-            preview = variants[1]["url"] if len(variants) > 1 else None
+        if cache:
+            cache.put(
+                key, reader.body, r.headers.get("ETag"), r.headers.get("Last-Modified")
+            )
 
-            data = {
-                "id": post.get("id"),
-                "url": post.get("file_url"),
-                "preview": preview,
-                "width": post.get("image_width"),
-                "height": post.get("image_height"),
-                "extension": post.get("file_ext"),
-                "tags": post.get("tag_string", "").split(),
-            }
+    @abstractmethod
+    def fetch_raw_posts(
+        self, tags: List[str], post_id: str, page: int, limit: int
+    ) -> Iterator[Dict[str, Any]]:
+        """Post objects exactly as the site returns them, as they arrive."""
+
+    @abstractmethod
+    def normalize_post(
+        self, post: Dict[str, Any], max_size: MaxSize = None
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Normalized post, or None when it lacks a usable file or preview.
+        With `max_size`, url/width/height describe the smallest variant
+        covering it instead of the original file, whose md5 then moves to
+        file_md5.
+        """
+
+    def iter_posts(
+        self,
+        tags: List[str],
+        post_id: str = "random",
+        page: int = 1,
+        limit: int = 6,
+        max_size: MaxSize = None,
+    ) -> Iterator[Dict[str, Any]]:
+        """Yield normalized posts one by one as they are parsed."""
+        yield from self._normalize_posts(
+            self.fetch_raw_posts(tags, post_id, page, limit), max_size
+        )
+
+    def fetch_page(
+        self, tags: List[str], page: int, limit: int, max_size: MaxSize = None
+    ) -> Tuple[List[Dict[str, Any]], int]:
+        """
+        Normalized posts of a listing page, with how many posts the site
+        returned for it: fewer than `limit` means the results end there.
+        """
+        raw_posts = list(self.fetch_raw_posts(tags, "random", page, limit))
+        return list(self._normalize_posts(raw_posts, max_size)), len(raw_posts)
+
+    def _normalize_posts(
+        self, raw_posts: Iterable[Dict[str, Any]], max_size: MaxSize
+    ) -> Iterator[Dict[str, Any]]:
+        seen = []
+        index = get_content_index()
+        for raw in raw_posts:
+            post = self.normalize_post(raw, max_size)
+            if post:
+                if not post.get("md5"):
+                    # No md5 from the API: use the one of the bytes, if downloaded
+                    post["md5"] = index.hash_for_url(post["url"])
+                seen.append(post)
+                yield post
+        self._observe_posts(seen)
+
+    def fetch_posts(
+        self,
+        tags: List[str],
+        post_id: str = "random",
+        page: int = 1,
+        limit: int = 6,
+        max_size: MaxSize = None,
+    ) -> Optional[List[Dict[str, Any]]]:
+        return list(self.iter_posts(tags, post_id, page, limit, max_size)) or None
+
+    def random_query(self, tags: List[str]) -> List[str]:
+        """Tag query returning posts matching `tags` in random order."""
+        return [*tags, self.RANDOM_TAG]
+
+    def _posts_kind(self, tags: List[str], post_id: str) -> str:
+        """Response cache kind of a post request."""
+        if post_id != "random":
+            return "post"
+        return "random" if self.RANDOM_TAG in tags else "posts"
+
+    def ids_query(self, ids: List[int]) -> List[str]:
+        """Tag query matching any of `ids` (Danbooru's id:1,2,3 form)."""
+        return [f"id:{','.join(str(i) for i in ids)}"]
+
+    def fetch_posts_by_ids(
+        self, ids: List[int], max_size: MaxSize = None
+    ) -> Dict[int, Dict[str, Any]]:
+        """Resolve many posts with one search per IDS_CHUNK ids, keyed by id."""
+        chunks = [
+            ids[i : i + self.IDS_CHUNK] for i in range(0, len(ids), self.IDS_CHUNK)
+        ]
+        with ThreadPoolExecutor(max_workers=min(len(chunks), POOL_SIZE) or 1) as pool:
+            pages = pool.map(
+                lambda chunk: self.fetch_posts(
+                    self.ids_query(chunk), "random", 1, len(chunk), max_size
+                ),
+                chunks,
+            )
+            return {post["id"]: post for posts in pages for post in posts or []}
+
+    @abstractmethod
+    def fetch_tag_counts(self, tag: str, limit: int = 10) -> List[Tuple[str, int]]:
+        """Remote tag search returning (name, post count) pairs ordered by count."""
+
+    def fetch_tags(self, tag: str, limit: int = 10) -> List[str]:
+        """Tag autocomplete answered from the local index, falling back to the site."""
+        query = tag.strip().lower()
+        index = get_tag_index(self.API)
+        index.compact_if_large()
+
+        # Hits for a narrower query say nothing about a broader one's top tags
+        if index.covers(query):
+            return [name for name, _ in index.lookup(query, limit)]
+
+        pairs = self.fetch_tag_counts(tag, limit)
+        index.add(pairs, query, complete=len(pairs) < limit)
+        index.save()
+        return [name for name, _ in pairs]
+
+    def _observe_posts(self, posts: List[Dict[str, Any]]) -> None:
+        get_tag_index(self.API).observe([post["tags"] for post in posts])
+        get_cooccurrence_table(self.API).observe(posts)
+
+
+# ============================================================
+# Danbooru provider
+# ============================================================
+
+
+class DanbooruProvider(BooruProvider):
+    API = "danbooru"
+    NAME = "Danbooru"
+    BASE = "https://danbooru.donmai.us"
+    # Only what normalize_post reads, the rest of a post object is dead weight
+    POST_FIELDS = (
+        "id,file_url,image_width,image_height,file_ext,tag_string,md5,"
+        "media_asset[variants]"
+    )
+    TAG_FIELDS = "name,post_count"
+
+    def _create_session(self) -> requests.Session:
+        auth = (self.user, self.key) if self.user and self.key else None
+        return get_session(self.BASE, auth=auth)
+
+    def fetch_raw_posts(self, tags, post_id="random", page=1, limit=6):
+        if post_id == "random":
+            url = (
+                f"{self.BASE}/posts.json?"
+                f"limit={limit}&page={page}&tags=+{'+'.join(tags)}"
+            )
+        else:
+            url = f"{self.BASE}/posts/{post_id}.json"
+
+        return self._stream_json(
+            url,
+            params={"only": self.POST_FIELDS},
+            kind=self._posts_kind(tags, post_id),
+            key_parts=(normalize_tags(tags), page, limit, post_id),
+            not_found=f"Post not found (404): Post ID {post_id} does not exist",
+        )
 
-            if all(data.values()):
-                result.append(data)
+    def normalize_post(self, post, max_size=None):
+        variants = post.get("media_asset", {}).get("variants", [])
+        preview = variants[1]["url"] if len(variants) > 1 else None
+
+        data = {
+            "id": post.get("id"),
+            "url": post.get("file_url"),
+            "preview": preview,
+            "width": post.get("image_width"),
+            "height": post.get("image_height"),
+            "extension": post.get("file_ext"),
+            "tags": post.get("tag_string", "").split(),
+        }
 
-        return result or None
+        if not all(data.values()):
+            return None
+        data["md5"] = post.get("md5")
+        return apply_variant(
+            data,
+            [
+                {
+                    "type": v.get("type"),
+                    "url": v.get("url"),
+                    "width": v.get("width"),
+                    "height": v.get("height"),
+                    "extension": v.get("file_ext"),
+                }
+                for v in variants
+                # Crops cut the picture, only scaled variants can stand in for it
+                if v.get("type") != "crop"
+            ],
+            max_size,
+        )
 
-    def fetch_tags(self, tag: str, limit: int = 10):
-        url = f"{self.BASE}/tags.json"
+    def fetch_tag_counts(self, tag, limit=10):
         params = {
             "search[name_matches]": f"*{tag}*",
             "search[order]": "count",
             "limit": limit,
+            "only": self.TAG_FIELDS,
         }
-        headers = {"User-Agent": "AGSBooruViewer/1.0 (ArchLinux; Hyprland)"}
-        try:
-            r = requests.get(url, params=params, headers=headers, timeout=15)
-            r.raise_for_status()
-        except requests.exceptions.Timeout:
-            raise Exception(f"Request timeout after 15 seconds for Safebooru")
-        except requests.exceptions.ConnectionError:
-            raise Exception(
-                f"Connection error: Unable to reach Safebooru. Check your internet connection."
-            )
-        except requests.exceptions.HTTPError as e:
-            raise Exception(f"HTTP error {e.response.status_code}: {e.response.reason}")
-        except Exception as e:
-            raise Exception(str(e))
+        tags = self._get_json(
+            f"{self.BASE}/tags.json", params=params, kind="tags", key_parts=(tag, limit)
+        )
 
         try:
-            return [t["name"] for t in r.json()]
-        except (json.JSONDecodeError, KeyError, TypeError) as e:
+            return [(t["name"], int(t.get("post_count", 0))) for t in tags]
+        except (KeyError, TypeError, ValueError) as e:
             raise Exception(f"Failed to parse tag response: {str(e)}")
 
 
+# ============================================================
+# Gelbooru provider
+# ============================================================
+
+
+class GelbooruProvider(BooruProvider):
+    API = "gelbooru"
+    NAME = "Gelbooru"
+    BASE = "https://gelbooru.com/index.php"
+    TAG_PAGE_SIZE = 100
+    TAG_MAX_PAGES = 10
+    IDS_CHUNK = 20
+    TAG_MEMO_SIZE = 256
+
+    def __init__(self, api_user: Optional[str] = None, api_key: Optional[str] = None):
+        super().__init__(api_user, api_key)
+        self._tag_memo: Dict[Tuple[str, int], Tuple[float, List[Tuple[str, int]]]] = {}
+
+    def _create_session(self) -> requests.Session:
+        # Gelbooru authenticates through query parameters
+        return get_session(
+            self.BASE, params={"user_id": self.user, "api_key": self.key}
+        )
+
+    RANDOM_TAG = "sort:random"
+
+    def ids_query(self, ids):
+        # Gelbooru has no id list metatag, OR the ids together instead
+        return ["{" + " ~ ".join(f"id:{i}" for i in ids) + "}"]
+
+    def fetch_raw_posts(self, tags, post_id="random", page=1, limit=6):
+        params = {
+            "page": "dapi",
+            "s": "post",
+            "q": "index",
+            "json": "1",
+            "limit": limit,
+        }
+        if post_id != "random":
+            params["id"] = post_id
+        else:
+            params["pid"] = max(0, page - 1)
+            params["tags"] = " ".join(tags)
+
+        return self._stream_json(
+            self.BASE,
+            params=params,
+            kind=self._posts_kind(tags, post_id),
+            key_parts=(normalize_tags(tags), page, limit, post_id),
+            items_key="post",
+        )
+
+    def normalize_post(self, post, max_size=None):
+        url = post.get("file_url")
+        data = {
+            "id": post.get("id"),
+            "url": url,
+            "preview": post.get("preview_url"),
+            "width": post.get("width"),
+            "height": post.get("height"),
+            "extension": url.split(".")[-1] if url else None,
+            "tags": str(post.get("tags", "")).split(),
+        }
+
+        if not all(data.values()):
+            return None
+        data["md5"] = post.get("md5")
+        return apply_variant(
+            data,
+            [
+                {
+                    "type": kind,
+                    "url": post.get(f"{kind}_url"),
+                    "width": post.get(f"{kind}_width"),
+                    "height": post.get(f"{kind}_height"),
+                    "extension": str(post.get(f"{kind}_url") or "").split(".")[-1],
+                }
+                for kind in ("preview", "sample")
+            ],
+            max_size,
+        )
+
+    def fetch_tag_counts(self, tag, limit=10):
+        """
+        Top tags matching %tag% by post count.
+        Pages are requested in count order, so the first page normally holds
+        the answer; if the server ignores the ordering, further pages are
+        scanned (up to TAG_MAX_PAGES) keeping only the best `limit` in a heap.
+        """
+        memo_key = (tag, limit)
+        memo = self._tag_memo.get(memo_key)
+        if memo and time.time() - memo[0] < RESPONSE_CACHE_TTLS["tags"]:
+            return memo[1]
+
+        page_size = max(limit, self.TAG_PAGE_SIZE)
+        top: List[Tuple[int, str]] = []
+
+        for pid in range(self.TAG_MAX_PAGES):
+            params = {
+                "page": "dapi",
+                "s": "tag",
+                "q": "index",
+                "json": "1",
+                "name_pattern": f"%{tag}%",
+                "orderby": "count",
+                "order": "DESC",
+                "limit": page_size,
+                "pid": pid,
+            }
+            response = self._get_json(
+                self.BASE,
+                params=params,
+                kind="tags",
+                key_parts=(tag, page_size, pid),
+            )
+
+            try:
+                tags = response.get("tag", []) or []
+                counts = [
+                    (int(t.get("count", t.get("post_count", 0))), t["name"])
+                    for t in tags
+                    if t.get("name")
+                ]
+            except (AttributeError, KeyError, TypeError, ValueError) as e:
+                raise Exception(f"Failed to parse tag response: {str(e)}")
+
+            for entry in counts:
+                if len(top) < limit:
+                    heapq.heappush(top, entry)
+                elif entry > top[0]:
+                    heapq.heapreplace(top, entry)
+
+            ordered = all(a[0] >= b[0] for a, b in zip(counts, counts[1:]))
+            if len(tags) < page_size or (ordered and len(top) >= limit):
+                break
+
+        pairs = [(name, count) for count, name in sorted(top, reverse=True)]
+
+        if len(self._tag_memo) >= self.TAG_MEMO_SIZE:
+            self._tag_memo.pop(next(iter(self._tag_memo)))
+        self._tag_memo[memo_key] = (time.time(), pairs)
+        return pairs
+
+
+# ============================================================
+# Safebooru provider
+# ============================================================
+
+
+class SafebooruProvider(DanbooruProvider):
+    """
+    Safebooru (Danbooru-based) provider.
+    Uses the same API schema as Danbooru, but without authentication.
+    Optionally accepts API credentials (currently unused).
+    """
+
+    API = "safebooru"
+    NAME = "Safebooru"
+    BASE = "https://safebooru.donmai.us"
+    # EXCLUDE_TAGS = ["-animated"]
+
+    def _create_session(self) -> requests.Session:
+        return get_session(self.BASE)
+
+
 # ============================================================
 # Provider registry
 # ============================================================
@@ -585,139 +2250,1554 @@ def get_provider(
 
 
 # ============================================================
-# CLI
+# Page filling
 # ============================================================
 
 
-def main():
-    if len(sys.argv) < 2:
-        error = ErrorResponse(
-            "MISSING_ARGS",
-            "Missing required arguments. Use --api [danbooru|gelbooru|safebooru] and optional --id/--tags/--tag/--page/--limit/--api-user/--api-key.",
-        )
-        emit_error(error)
-        sys.exit(1)
+FILL_MAX_PAGES = 4
+FILL_STATE_PATH = BOORU_CACHE_DIR / "fill-state.json"
+FILL_STATE_MAX_KEYS = 20
 
-    api = None
-    post_id = "random"
-    tags: List[str] = []
-    page = 1
-    limit = 6
-    tag_query = None
-    api_user = None
-    api_key = None
-    action = None
-    payload_json = None
+_fill_state_lock = threading.Lock()
 
+
+def _read_fill_state() -> Dict[str, Any]:
     try:
-        for i in range(1, len(sys.argv)):
-            if sys.argv[i] == "--api":
-                api = sys.argv[i + 1].lower()
-            elif sys.argv[i] == "--id":
-                post_id = sys.argv[i + 1]
-            elif sys.argv[i] == "--tags":
-                tags = sys.argv[i + 1].split(",")
-            elif sys.argv[i] == "--tag":
-                tag_query = sys.argv[i + 1]
-            elif sys.argv[i] == "--page":
-                page = int(sys.argv[i + 1])
-            elif sys.argv[i] == "--limit":
-                limit = int(sys.argv[i + 1])
-            elif sys.argv[i] == "--api-user":
-                api_user = sys.argv[i + 1]
-            elif sys.argv[i] == "--api-key":
-                api_key = sys.argv[i + 1]
-            elif sys.argv[i] == "--action":
-                action = sys.argv[i + 1].strip().lower()
-            elif sys.argv[i] == "--payload-json":
-                payload_json = sys.argv[i + 1]
-    except (IndexError, ValueError) as e:
-        error = ErrorResponse("INVALID_ARGS", f"Invalid argument format: {str(e)}")
-        emit_error(error)
-        sys.exit(1)
+        state = json.loads(FILL_STATE_PATH.read_text(encoding="utf-8"))
+        return state if isinstance(state, dict) else {}
+    except (OSError, json.JSONDecodeError):
+        return {}
 
-    if action:
-        payload: Dict[str, Any] = {}
-        if payload_json:
-            try:
-                parsed_payload = json.loads(payload_json)
-            except json.JSONDecodeError as exc:
-                error = ErrorResponse(
-                    "INVALID_PAYLOAD", f"Invalid payload JSON: {str(exc)}"
-                )
-                emit_error(error)
-                sys.exit(1)
 
-            if not isinstance(parsed_payload, dict):
-                error = ErrorResponse(
-                    "INVALID_PAYLOAD", "Payload JSON must be an object."
-                )
-                emit_error(error)
-                sys.exit(1)
-            payload = parsed_payload
+def fill_cursor(key: str, page: int) -> Tuple[int, int]:
+    """Remote (page, skip) a filled page starts at; plain paging if unknown."""
+    cursor = _read_fill_state().get(key, {}).get(str(page))
+    return (cursor[0], cursor[1]) if cursor else (page, 0)
+
 
+def save_fill_cursor(key: str, page: int, cursor: Tuple[int, int]) -> None:
+    with _fill_state_lock:
+        state = _read_fill_state()
+        cursors = state.pop(key, {})
+        cursors[str(page)] = list(cursor)
+        state[key] = cursors  # most recently used tag sets last
+        for stale in list(state)[:-FILL_STATE_MAX_KEYS]:
+            del state[stale]
         try:
-            result = run_bookmark_action(action, payload)
-            print(json.dumps(result))
-            return
-        except Exception as e:
-            error = ErrorResponse("BOOKMARK_ACTION_FAILED", str(e))
-            emit_error(error)
-            sys.exit(1)
+            atomic_write_json(FILL_STATE_PATH, state)
+        except OSError:
+            pass
+
+
+def fetch_filled(
+    provider: BooruProvider,
+    tags: List[str],
+    page: int,
+    limit: int,
+    max_pages: int = FILL_MAX_PAGES,
+    on_post: Optional[Callable[[Dict[str, Any]], None]] = None,
+    max_size: MaxSize = None,
+) -> List[Dict[str, Any]]:
+    """
+    Collect `limit` valid posts for a page even when filtering drops some.
+    Follow-up remote pages are fetched concurrently, sized from the valid
+    ratio seen so far, until a remote page comes back short, which marks the
+    end of the results. Where the page ended (remote page and how many of
+    its posts were used) is remembered so the next page continues from
+    there; the cursor never moves past a page the site returned empty.
+    `on_post` sees each post as soon as it is collected.
+    """
+    key = ResponseCache.key("fill", provider.API, normalize_tags(tags), limit)
+    first_page, skip = fill_cursor(key, page)
+
+    collected: List[Dict[str, Any]] = []
+    seen_ids = set()
+    fetched = 0
+    batch = [first_page]
+    # last_size stays None until a non-empty remote page is read
+    last_page, used, last_size = first_page, skip, None
+    exhausted = False
+
+    with ThreadPoolExecutor(max_workers=max_pages) as pool:
+        while batch and len(collected) < limit:
+            try:
+                pages = list(
+                    pool.map(
+                        lambda p: provider.fetch_page(tags, p, limit, max_size),
+                        batch,
+                    )
+                )
+            except Exception:
+                if collected:
+                    break
+                raise
+            fetched += len(batch)
+
+            for remote_page, (posts, raw_count) in zip(batch, pages):
+                if raw_count == 0:
+                    exhausted = True
+                    break
+                start = skip if remote_page == first_page else 0
+                last_page, used, last_size = remote_page, start, len(posts)
+                for post in posts[start:]:
+                    if len(collected) >= limit:
+                        break
+                    used += 1
+                    if post["id"] not in seen_ids:
+                        seen_ids.add(post["id"])
+                        collected.append(post)
+                        if on_post:
+                            on_post(post)
+                if len(collected) >= limit or raw_count < limit:
+                    exhausted = raw_count < limit
+                    break
+
+            if exhausted or len(collected) >= limit or fetched >= max_pages:
+                break
+            valid_per_page = max(len(collected) / fetched, 1.0)
+            wanted = math.ceil((limit - len(collected)) / valid_per_page)
+            count = min(wanted, max_pages - fetched)
+            batch = list(range(last_page + 1, last_page + 1 + count))
+
+    if last_size is None:
+        cursor = (first_page, skip)
+    elif used < last_size:
+        cursor = (last_page, used)
+    else:
+        cursor = (last_page + 1, 0)
+    save_fill_cursor(key, page + 1, cursor)
+    return collected
 
-    if not api:
-        error = ErrorResponse(
+
+# ============================================================
+# Prefetch
+# ============================================================
+
+
+PREFETCH_MAX_DEPTH = 3
+PREFETCH_TOKEN_PATH = BOORU_CACHE_DIR / "prefetch.token"
+PREVIEW_ACCEPT = "image/avif,image/webp,image/png,image/svg+xml,image/*;q=0.8"
+
+
+def browsing_token(api: str, tags: List[str]) -> str:
+    return ResponseCache.key("browse", api, normalize_tags(tags))
+
+
+def current_browsing_token() -> Optional[str]:
+    try:
+        return PREFETCH_TOKEN_PATH.read_text(encoding="utf-8").strip()
+    except OSError:
+        return None
+
+
+def set_browsing_token(token: str) -> None:
+    """Record the tag set being browsed; prefetches for any other set stop."""
+    if current_browsing_token() == token:
+        return
+    try:
+        atomic_write_text(PREFETCH_TOKEN_PATH, token)
+    except OSError:
+        pass
+
+
+def preview_path(api: str, post: Dict[str, Any]) -> Path:
+    """Same location BooruViewer downloads previews to."""
+    return BOORU_CACHE_DIR / api / "previews" / f"{post['id']}.{post['extension']}"
+
+
+def download_preview(provider: BooruProvider, post: Dict[str, Any]) -> Optional[Path]:
+    path = preview_path(provider.API, post)
+    if path.exists():
+        return path
+
+    parts = urlsplit(provider.BASE)
+    headers = {"Referer": f"{parts.scheme}://{parts.netloc}/", "Accept": PREVIEW_ACCEPT}
+    tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.part")
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # The CDN gets its own credential-free session: the provider's would
+        # leak auth/api_key to it and churn the API host's keep-alive pool
+        with get_session(post["preview"]).get(
+            post["preview"], headers=headers, timeout=REQUEST_TIMEOUT, stream=True
+        ) as r:
+            r.raise_for_status()
+            with open(tmp_path, "wb") as f:
+                for chunk in r.iter_content(chunk_size=64 * 1024):
+                    f.write(chunk)
+        os.replace(tmp_path, path)
+        return path
+    except Exception:
+        tmp_path.unlink(missing_ok=True)
+        return None
+
+
+def prefetch_pages(provider: BooruProvider, job: Dict[str, Any]) -> None:
+    """
+    Warm the response cache and preview files for the pages after job["page"].
+    Stops as soon as the browsed tag set changes.
+    """
+    try:
+        warm_pages(provider, job)
+    finally:
+        # Off the request path: a good time to fold the posts seen while browsing
+        get_tag_index(provider.API).compact_if_large()
+        get_cooccurrence_table(provider.API).compact_if_large()
+
+
+def warm_pages(provider: BooruProvider, job: Dict[str, Any]) -> None:
+    tags, limit, token = job["tags"], job["limit"], job["token"]
+    depth = min(job["depth"], PREFETCH_MAX_DEPTH)
+
+    if job.get("random"):
+        refill_random_pool(provider, tags, previews=depth > 0)
+        return
+
+    for next_page in range(job["page"] + 1, job["page"] + 1 + depth):
+        if current_browsing_token() != token:
+            return
+        try:
+            if job.get("fill"):
+                posts = fetch_filled(provider, tags, next_page, limit)
+            else:
+                posts = provider.fetch_posts(tags, "random", next_page, limit)
+        except Exception:
+            return
+
+        for post in posts or []:
+            if current_browsing_token() != token:
+                return
+            download_preview(provider, post)
+        if len(posts or []) < limit:
+            return  # past the last page
+
+
+def prefetch_job(request: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "api": request["api"],
+        "api_user": request.get("api_user"),
+        "api_key": request.get("api_key"),
+        "tags": request["tags"],
+        "page": request["page"],
+        "limit": request["limit"],
+        "depth": request["prefetch"],
+        "fill": bool(request.get("fill")),
+        "random": bool(request.get("random")),
+        "token": browsing_token(request["api"], request["tags"]),
+    }
+
+
+def spawn_prefetch(provider: BooruProvider, request: Dict[str, Any]) -> None:
+    """Run the prefetch in a detached process so the CLI can return right away."""
+    try:
+        process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--prefetch-job"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+        # Credentials go through stdin rather than the process list
+        process.stdin.write(json.dumps(prefetch_job(request)).encode("utf-8"))
+        process.stdin.close()
+    except OSError:
+        pass
+
+
+def run_prefetch_job(job: Dict[str, Any]) -> None:
+    provider = get_provider(job["api"], job.get("api_user"), job.get("api_key"))
+    if provider:
+        prefetch_pages(provider, job)
+
+
+# ============================================================
+# Random pool
+# ============================================================
+
+
+RANDOM_POOL_DIR = BOORU_CACHE_DIR / "random"
+RANDOM_POOL_SIZE = 24
+RANDOM_POOL_LOW_WATER = 8
+RANDOM_POOL_MAX_KEYS = 16
+
+
+class RandomPool:
+    """
+    Posts drawn ahead of time for random requests on one api and tag set.
+    Entries are raw posts already checked to normalize, so --max-width still
+    applies when they are handed out. The pool file is shared by every
+    booru.py process and updated under flock; each post is served once.
+    """
+
+    def __init__(self, api: str, tags: List[str]):
+        key = ResponseCache.key("random", api, normalize_tags(tags))
+        self.path = RANDOM_POOL_DIR / f"{key}.json"
+
+    @contextmanager
+    def _posts(self) -> Iterator[List[Dict[str, Any]]]:
+        """Locked read-modify-write of the pooled posts."""
+        with locked_json_file(self.path, []) as posts:
+            yield posts
+
+    def take(self, count: int) -> Tuple[List[Dict[str, Any]], int]:
+        """Pop up to `count` posts, returning them and how many are left."""
+        with self._posts() as posts:
+            taken = posts[:count]
+            del posts[:count]
+            return taken, len(posts)
+
+    def add(self, new_posts: List[Dict[str, Any]]) -> int:
+        """Append posts not pooled yet, returning the pool size."""
+        with self._posts() as posts:
+            pooled = {post.get("id") for post in posts}
+            for post in new_posts:
+                if post.get("id") not in pooled and len(posts) < 2 * RANDOM_POOL_SIZE:
+                    pooled.add(post.get("id"))
+                    posts.append(post)
+            size = len(posts)
+
+        # Forget the pools of tag sets not browsed for a while
+        try:
+            pools = sorted(
+                RANDOM_POOL_DIR.glob("*.json"), key=lambda p: p.stat().st_mtime
+            )
+            for stale in pools[:-RANDOM_POOL_MAX_KEYS]:
+                stale.unlink(missing_ok=True)
+        except OSError:
+            pass
+        return size
+
+
+def refill_random_pool(
+    provider: BooruProvider,
+    tags: List[str],
+    previews: bool = False,
+    wait: bool = False,
+) -> int:
+    """
+    Draw RANDOM_POOL_SIZE random posts into the pool for `tags`.
+    A refill already running elsewhere makes this one return right away,
+    or with `wait`, block until it is done and only refill if still low.
+    """
+    pool = RandomPool(provider.API, tags)
+    pool.path.parent.mkdir(parents=True, exist_ok=True)
+    with open(pool.path.with_suffix(".refill"), "a") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            if not wait:
+                return 0
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            _, size = pool.take(0)
+            if size >= RANDOM_POOL_LOW_WATER:
+                return size
+
+        raw_posts = provider.fetch_raw_posts(
+            provider.random_query(tags), "random", 1, RANDOM_POOL_SIZE
+        )
+        valid = []
+        normalized = []
+        for raw in raw_posts:
+            post = provider.normalize_post(raw)
+            if post:
+                valid.append(raw)
+                normalized.append(post)
+        provider._observe_posts(normalized)
+        size = pool.add(valid)
+
+    if previews:
+        for post in normalized:
+            download_preview(provider, post)
+    return size
+
+
+def draw_random(
+    provider: BooruProvider,
+    tags: List[str],
+    limit: int,
+    max_size: MaxSize = None,
+) -> Tuple[List[Dict[str, Any]], int]:
+    """
+    `limit` random posts for `tags`, answered from the pool when it holds
+    enough and refilled inline otherwise. Returns the posts and the number
+    still pooled so the caller can schedule a background refill.
+    """
+    pool = RandomPool(provider.API, tags)
+    raw_posts, left = pool.take(limit)
+    if len(raw_posts) < limit:
+        refill_random_pool(provider, tags, wait=True)
+        more, left = pool.take(limit - len(raw_posts))
+        raw_posts += more
+
+    posts = [provider.normalize_post(raw, max_size) for raw in raw_posts]
+    return [post for post in posts if post], left
+
+
+# ============================================================
+# Content hashes
+# ============================================================
+
+
+CONTENT_INDEX_PATH = BOORU_CACHE_DIR / "hashes.json"
+# Perceptual matching is opt-in: it needs Pillow and may merge near-identical art
+PERCEPTUAL_HASHING = os.environ.get("AGS_BOORU_PERCEPTUAL") == "1"
+PERCEPTUAL_MAX_DISTANCE = 6
+CONTENT_INDEX_MAX_URLS = 50000
+
+
+def set_perceptual_hashing(enabled: bool) -> None:
+    global PERCEPTUAL_HASHING
+    PERCEPTUAL_HASHING = enabled
+
+
+def dhash(path: Path, size: int = 8) -> Optional[int]:
+    """64-bit difference hash of an image, None when it can't be computed."""
+    try:
+        from PIL import Image  # optional, only needed for perceptual matching
+    except ImportError:
+        return None
+    try:
+        with Image.open(path) as image:
+            pixels = list(
+                image.convert("L").resize((size + 1, size), Image.LANCZOS).getdata()
+            )
+    except Exception:
+        return None
+
+    value = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            value = value << 1 | (left > pixels[row * (size + 1) + col + 1])
+    return value
+
+
+class ContentIndex:
+    """
+    Content hashes shared by results, bookmarks and the media store.
+
+    Posts are identified by their md5: the API's when it has one, else the
+    md5 of the bytes downloaded from the post's url. With perceptual
+    hashing on, downloaded images also get a dHash; one within
+    PERCEPTUAL_MAX_DISTANCE bits of a known image (a re-encode or resize)
+    maps its md5 to that image's md5, the canonical one.
+    """
+
+    def __init__(self, path: Optional[Path] = None):
+        self.path = path or CONTENT_INDEX_PATH
+        self.urls: Dict[str, str] = {}
+        self.canonical_of: Dict[str, str] = {}
+        self.dhashes: Dict[str, int] = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _read(self) -> None:
+        try:
+            data = json.loads(self.path.read_text(encoding="utf-8"))
+            self.urls = data.get("urls", {})
+            self.canonical_of = data.get("canonical", {})
+            self.dhashes = data.get("dhash", {})
+        except (OSError, json.JSONDecodeError, AttributeError):
+            pass
+        self._loaded = True
+
+    def _load(self) -> None:
+        if not self._loaded:
+            self._read()
+
+    def hash_for_url(self, url: str) -> Optional[str]:
+        with self._lock:
+            self._load()
+            return self.urls.get(url)
+
+    def canonical(self, md5: str) -> str:
+        with self._lock:
+            self._load()
+            return self.canonical_of.get(md5, md5)
+
+    def record(self, url: str, md5: str, path: Optional[Path] = None) -> str:
+        """
+        Remember the md5 of the bytes at `url`, plus its dHash in perceptual
+        mode. Returns the canonical md5 for that content.
+        """
+        fingerprint = dhash(path) if PERCEPTUAL_HASHING and path else None
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._lock, open(self.path.with_suffix(".lock"), "a") as lock:
+            # Merge with what other processes recorded since we last read
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._read()
+
+            self.urls.pop(url, None)
+            self.urls[url] = md5
+            for stale in list(self.urls)[:-CONTENT_INDEX_MAX_URLS]:
+                del self.urls[stale]
+
+            if fingerprint is not None and md5 not in self.canonical_of:
+                for known, other in self.dhashes.items():
+                    if known != md5 and bin(fingerprint ^ other).count("1") <= (
+                        PERCEPTUAL_MAX_DISTANCE
+                    ):
+                        self.canonical_of[md5] = self.canonical_of.get(known, known)
+                        break
+                else:
+                    self.dhashes[md5] = fingerprint
+
+            try:
+                atomic_write_json(
+                    self.path,
+                    {
+                        "urls": self.urls,
+                        "canonical": self.canonical_of,
+                        "dhash": self.dhashes,
+                    },
+                )
+            except OSError:
+                pass
+            return self.canonical_of.get(md5, md5)
+
+
+_content_index: Optional[ContentIndex] = None
+
+
+def get_content_index() -> ContentIndex:
+    global _content_index
+    if _content_index is None:
+        _content_index = ContentIndex()
+    return _content_index
+
+
+# ============================================================
+# Media store
+# ============================================================
+
+
+MEDIA_DIR = BOORU_CACHE_DIR / "media"
+MEDIA_MAX_BYTES = int(os.environ.get("AGS_BOORU_MEDIA_MAX_MB", "2048")) * 1024 * 1024
+MEDIA_CHUNK_SIZE = 256 * 1024
+# Partial downloads nobody resumed within this long are dropped by evict()
+MEDIA_PARTIAL_MAX_AGE = 24 * 60 * 60
+
+
+class MediaStore:
+    """
+    Content-addressed media files: media/<md5[:2]>/<md5>.<ext>.
+    The same file found on several boorus or tag searches is stored once;
+    aliases.json maps each download url to its stored file so urls without
+    a known md5 are still served locally. Interrupted downloads are kept as
+    partial/<sha1(url)>.part and resumed with a Range request, unless the
+    server refused the url or nothing arrived. File mtimes track recency for
+    LRU eviction down to max_bytes, which runs after every download.
+    """
+
+    def __init__(self, root: Optional[Path] = None, max_bytes: Optional[int] = None):
+        self.root = root or MEDIA_DIR
+        self.max_bytes = max_bytes or MEDIA_MAX_BYTES
+        self.aliases_path = self.root / "aliases.json"
+        self._lock = threading.Lock()
+
+    def path(self, md5: str, extension: str) -> Path:
+        return self.root / md5[:2] / f"{md5}.{extension}"
+
+    def _read_aliases(self) -> Dict[str, str]:
+        try:
+            aliases = json.loads(self.aliases_path.read_text(encoding="utf-8"))
+            return aliases if isinstance(aliases, dict) else {}
+        except (OSError, json.JSONDecodeError):
+            return {}
+
+    @contextmanager
+    def _aliases_locked(self) -> Iterator[None]:
+        """Serialize aliases.json read-modify-writes across threads and processes."""
+        self.root.mkdir(parents=True, exist_ok=True)
+        with self._lock, open(self.root / "aliases.lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def _write_aliases(self, aliases: Dict[str, str]) -> None:
+        try:
+            atomic_write_json(self.aliases_path, aliases)
+        except OSError:
+            pass
+
+    def lookup(
+        self, url: str, md5: Optional[str] = None, extension: Optional[str] = None
+    ) -> Optional[Path]:
+        """Stored file for a url or md5, marked as recently used."""
+        candidates = []
+        if md5:
+            canonical = get_content_index().canonical(md5)
+            if extension:
+                candidates.append(self.path(canonical, extension))
+            # The same bytes may have been stored under another extension
+            candidates.extend(
+                path
+                for path in self.root.joinpath(canonical[:2]).glob(f"{canonical}.*")
+                if path.suffix != ".part"
+            )
+        alias = self._read_aliases().get(url)
+        if alias:
+            candidates.append(self.root / alias)
+        for path in candidates:
+            try:
+                os.utime(path)
+                return path
+            except OSError:
+                continue
+        return None
+
+    def fetch(
+        self,
+        session: requests.Session,
+        url: str,
+        md5: Optional[str] = None,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> Tuple[Path, bool]:
+        """Stored file for `url`, downloading it if needed. Returns (path, cached)."""
+        extension = urlsplit(url).path.rsplit(".", 1)[-1].lower() or "bin"
+        md5 = md5.lower() if md5 else None
+        path = self.lookup(url, md5, extension)
+        if path:
+            return path, True
+
+        partial_dir = self.root / "partial"
+        partial_dir.mkdir(parents=True, exist_ok=True)
+        part_path = (
+            partial_dir / f"{hashlib.sha1(url.encode('utf-8')).hexdigest()}.part"
+        )
+
+        while True:
+            with open(part_path, "a+b") as part:
+                # Another process downloading the same url: wait, then reuse its file
+                fcntl.flock(part, fcntl.LOCK_EX)
+                path = self.lookup(url, md5, extension)
+                if path:
+                    return path, True
+                try:
+                    current = (
+                        os.stat(part_path).st_ino == os.fstat(part.fileno()).st_ino
+                    )
+                except OSError:
+                    current = False
+                if not current:
+                    # The previous holder renamed or dropped the file we waited on
+                    continue
+                try:
+                    path = self._store(
+                        session, url, md5, extension, part, part_path, headers
+                    )
+                except Exception as exc:
+                    if not self._resumable(exc, part):
+                        part_path.unlink(missing_ok=True)
+                    raise
+                break
+
+        self.evict(keep=path)
+        return path, False
+
+    def _store(
+        self,
+        session: requests.Session,
+        url: str,
+        md5: Optional[str],
+        extension: str,
+        part: Any,
+        part_path: Path,
+        headers: Optional[Dict[str, str]],
+    ) -> Path:
+        """
+        Download into the locked partial file and move it into the store.
+        Runs entirely under the partial file's lock, so a waiter never sees
+        the file half-renamed or the url without its alias.
+        """
+        digest = self._download(session, url, part, headers or {})
+        if md5 and digest != md5:
+            part_path.unlink(missing_ok=True)
+            raise Exception(
+                f"Checksum mismatch for {url}: expected {md5}, got {digest}"
+            )
+
+        path = self.path(digest, extension)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(part_path, path)
+
+        canonical = get_content_index().record(url, digest, path)
+        if canonical != digest:
+            # A perceptual duplicate of a stored file: keep only the first copy
+            existing = self.lookup(url="", md5=canonical)
+            if existing:
+                path.unlink(missing_ok=True)
+                path = existing
+
+        with self._aliases_locked():
+            aliases = self._read_aliases()
+            aliases[url] = str(path.relative_to(self.root))
+            self._write_aliases(aliases)
+        return path
+
+    @staticmethod
+    def _resumable(exc: Exception, part: Any) -> bool:
+        """Whether a failed download left bytes worth resuming later."""
+        if isinstance(exc, requests.HTTPError) and exc.response is not None:
+            if 400 <= exc.response.status_code < 500:
+                return False  # refused, a retry starts over anyway
+        try:
+            return os.fstat(part.fileno()).st_size > 0
+        except OSError:
+            return False
+
+    def _download(
+        self,
+        session: requests.Session,
+        url: str,
+        part: Any,
+        headers: Dict[str, str],
+    ) -> str:
+        """Stream `url` into the open partial file, resuming it; returns its md5."""
+        part.seek(0, os.SEEK_END)
+        offset = part.tell()
+        if offset:
+            headers = {**headers, "Range": f"bytes={offset}-"}
+
+        with session.get(
+            url, headers=headers, timeout=REQUEST_TIMEOUT, stream=True
+        ) as r:
+            if r.status_code == 416:
+                # The previous attempt already got everything
+                pass
+            else:
+                r.raise_for_status()
+                if r.status_code != 206:
+                    part.seek(0)
+                    part.truncate()
+                for chunk in r.iter_content(chunk_size=MEDIA_CHUNK_SIZE):
+                    part.write(chunk)
+        part.flush()
+
+        digest = hashlib.md5()
+        part.seek(0)
+        for chunk in iter(lambda: part.read(MEDIA_CHUNK_SIZE), b""):
+            digest.update(chunk)
+        return digest.hexdigest()
+
+    def _drop_stale_partials(self) -> None:
+        """Remove partial downloads older than MEDIA_PARTIAL_MAX_AGE."""
+        cutoff = time.time() - MEDIA_PARTIAL_MAX_AGE
+        for path in self.root.glob("*/*.part"):
+            try:
+                if path.stat().st_mtime >= cutoff:
+                    continue
+                with open(path, "rb") as part:
+                    # A download holding it keeps it, however old
+                    fcntl.flock(part, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    path.unlink()
+            except OSError:
+                continue
+
+    def evict(self, keep: Optional[Path] = None) -> None:
+        """
+        Drop least recently used files until the store fits in max_bytes,
+        and partial downloads left behind long ago.
+        """
+        self._drop_stale_partials()
+        with self._aliases_locked():
+            files = []
+            for directory in self.root.glob("??"):
+                try:
+                    files.extend(
+                        (e.stat().st_mtime, e.stat().st_size, Path(e.path))
+                        for e in os.scandir(directory)
+                        if e.is_file() and not e.name.endswith(".part")
+                    )
+                except OSError:
+                    continue
+
+            total = sum(size for _, size, _ in files)
+            if total <= self.max_bytes:
+                return
+
+            files.sort()
+            removed = set()
+            for _, size, path in files:
+                if total <= self.max_bytes:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    path.unlink()
+                    total -= size
+                    removed.add(str(path.relative_to(self.root)))
+                except OSError:
+                    pass
+
+            aliases = self._read_aliases()
+            self._write_aliases(
+                {url: rel for url, rel in aliases.items() if rel not in removed}
+            )
+
+
+_media_store: Optional[MediaStore] = None
+
+
+def get_media_store() -> MediaStore:
+    global _media_store
+    if _media_store is None:
+        _media_store = MediaStore()
+    return _media_store
+
+
+def download_media(request: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Fetch request["download"] into the media store.
+    With request["output"], that path becomes a symlink to the stored file,
+    so callers keep their own layout while the store bounds disk usage.
+    """
+    url = request["download"]
+    headers = {}
+    provider = get_provider(request["api"]) if request.get("api") else None
+    if provider:
+        # Some CDNs refuse hotlinked media without the site as referer
+        parts = urlsplit(provider.BASE)
+        headers["Referer"] = f"{parts.scheme}://{parts.netloc}/"
+
+    path, cached = get_media_store().fetch(
+        get_session(url), url, request.get("md5"), headers
+    )
+
+    result = {"path": str(path), "cached": cached, "size": path.stat().st_size}
+    if request.get("output"):
+        output = Path(request["output"]).expanduser()
+        output.parent.mkdir(parents=True, exist_ok=True)
+        tmp_link = output.with_name(f".{output.name}.{os.getpid()}.link")
+        tmp_link.unlink(missing_ok=True)
+        tmp_link.symlink_to(path)
+        os.replace(tmp_link, output)
+        result["output"] = str(output)
+    return result
+
+
+# ============================================================
+# Federated search
+# ============================================================
+
+
+FEDERATED_TIMEOUT = 10
+
+
+def post_identity(post: Dict[str, Any]) -> Tuple[str, Any]:
+    """Content identity of a post: its canonical md5 when one is known."""
+    md5 = post.get("file_md5") or post.get("md5")
+    if md5:
+        return ("md5", get_content_index().canonical(md5))
+    return (post.get("api", ""), post.get("id"))
+
+
+def merge_posts(results: List[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """Interleave provider results round-robin, dropping content duplicates."""
+    merged: List[Dict[str, Any]] = []
+    seen = set()
+    for post in itertools.chain.from_iterable(itertools.zip_longest(*results)):
+        if post is None:
+            continue
+        identity = post_identity(post)
+        if identity in seen:
+            continue
+        seen.add(identity)
+        merged.append(post)
+    return merged
+
+
+def fetch_federated(
+    providers: List[BooruProvider],
+    tags: List[str],
+    page: int,
+    limit: int,
+    timeout: float = FEDERATED_TIMEOUT,
+    on_post: Optional[Callable[[Dict[str, Any]], None]] = None,
+    max_size: MaxSize = None,
+) -> Tuple[List[Dict[str, Any]], Dict[str, str]]:
+    """
+    Run fetch_posts on every provider concurrently.
+    Returns the merged posts and an error message per provider that failed
+    or missed the deadline, so total latency is bounded by `timeout`.
+    `on_post` sees deduplicated posts in arrival order, as each provider
+    answers, rather than in the final round-robin order.
+    """
+    done: "queue.Queue[Tuple[str, Any, Optional[str]]]" = queue.Queue()
+
+    def run(provider: BooruProvider) -> None:
+        try:
+            posts = provider.fetch_posts(tags, "random", page, limit, max_size) or []
+            done.put((provider.API, posts, None))
+        except Exception as e:
+            done.put((provider.API, [], str(e)))
+
+    # Daemon threads: a provider past its deadline must not hold the process open
+    for provider in providers:
+        threading.Thread(target=run, args=(provider,), daemon=True).start()
+
+    results: Dict[str, List[Dict[str, Any]]] = {}
+    errors: Dict[str, str] = {}
+    emitted = set()
+    deadline = time.monotonic() + timeout
+    while len(results) + len(errors) < len(providers):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            api, posts, error = done.get(timeout=remaining)
+        except queue.Empty:
+            break
+        if error:
+            errors[api] = error
+        else:
+            results[api] = [{**post, "api": api} for post in posts]
+            for post in results[api] if on_post else []:
+                identity = post_identity(post)
+                if identity not in emitted:
+                    emitted.add(identity)
+                    on_post(post)
+
+    for provider in providers:
+        if provider.API not in results and provider.API not in errors:
+            errors[provider.API] = f"Timed out after {timeout} seconds"
+
+    ordered = [results[p.API] for p in providers if p.API in results]
+    return merge_posts(ordered), errors
+
+
+# ============================================================
+# Request handling
+# ============================================================
+
+
+class RequestError(Exception):
+    """Failure while handling a request, carrying a structured error."""
+
+    def __init__(self, code: str, message: str):
+        super().__init__(message)
+        self.error = ErrorResponse(code, message)
+
+
+def default_request() -> Dict[str, Any]:
+    return {
+        "api": None,
+        "post_id": "random",
+        "tags": [],
+        "page": 1,
+        "limit": 6,
+        "tag": None,
+        "api_user": None,
+        "api_key": None,
+        "action": None,
+        "payload": {},
+        "prefetch": 0,
+        "stream": False,
+        "max_width": None,
+        "max_height": None,
+    }
+
+
+def request_max_size(request: Dict[str, Any]) -> MaxSize:
+    """Display bounds asked for with --max-width/--max-height, if any."""
+    if request.get("max_width") or request.get("max_height"):
+        return (request.get("max_width"), request.get("max_height"))
+    return None
+
+
+def handle_federated_request(
+    request: Dict[str, Any],
+    apis: List[str],
+    provider_factory: Callable[
+        [str, Optional[str], Optional[str]], Optional[BooruProvider]
+    ],
+    emit: Optional[Callable[[Dict[str, Any]], None]] = None,
+) -> List[Dict[str, Any]]:
+    """Post listing across several providers, e.g. --api danbooru,safebooru."""
+    if (
+        request.get("tag")
+        or request.get("ids")
+        or request.get("random")
+        or request["post_id"] != "random"
+    ):
+        raise RequestError(
+            "INVALID_ARGS",
+            "Tag search, --random and --id/--ids need a single --api; several are only supported for post listing.",
+        )
+
+    credentials = request.get("credentials") or {}
+    providers: List[BooruProvider] = []
+    errors: Dict[str, str] = {}
+    for api in apis:
+        api_credentials = credentials.get(api) or {}
+        api_user = api_credentials.get("user") or request.get("api_user")
+        api_key = api_credentials.get("key") or request.get("api_key")
+        if api in {"danbooru", "gelbooru"} and (not api_user or not api_key):
+            errors[api] = "missing credentials"
+            continue
+        provider = provider_factory(api, api_user, api_key)
+        if provider:
+            providers.append(provider)
+
+    if not providers:
+        raise RequestError(
+            "MISSING_CREDENTIALS",
+            "danbooru/gelbooru require credentials, pass them with --credentials-json.",
+        )
+
+    posts, fetch_errors = fetch_federated(
+        providers,
+        request["tags"],
+        request["page"],
+        request["limit"],
+        request.get("timeout") or FEDERATED_TIMEOUT,
+        on_post=emit,
+        max_size=request_max_size(request),
+    )
+    errors.update(fetch_errors)
+
+    if not posts:
+        if errors:
+            raise RequestError(
+                "UNEXPECTED_ERROR",
+                "; ".join(f"{api}: {message}" for api, message in errors.items()),
+            )
+        raise RequestError(
+            "NO_RESULTS",
+            "No results found. Try different tags or verify the post exists.",
+        )
+
+    return posts
+
+
+def handle_request(
+    request: Dict[str, Any],
+    provider_factory: Callable[
+        [str, Optional[str], Optional[str]], Optional[BooruProvider]
+    ] = get_provider,
+    prefetcher: Callable[[BooruProvider, Dict[str, Any]], None] = spawn_prefetch,
+    emit: Optional[Callable[[Dict[str, Any]], None]] = None,
+) -> Any:
+    """
+    Run a single booru request and return its JSON-serializable result.
+    For post listings, `emit` is called with each post as soon as it is
+    parsed; the full list is still returned once the request completes.
+    """
+    action = request.get("action")
+    if action:
+        try:
+            return run_bookmark_action(action, request.get("payload") or {})
+        except Exception as e:
+            raise RequestError("BOOKMARK_ACTION_FAILED", str(e))
+
+    if request.get("download"):
+        try:
+            return download_media(request)
+        except Exception as e:
+            raise RequestError("DOWNLOAD_FAILED", str(e))
+
+    apis = [a.strip() for a in (request.get("api") or "").split(",") if a.strip()]
+    api_user = request.get("api_user")
+    api_key = request.get("api_key")
+
+    if not apis:
+        raise RequestError(
             "MISSING_API",
             "API source is required. Use --api [danbooru|gelbooru|safebooru].",
         )
-        emit_error(error)
-        sys.exit(1)
 
-    if api not in SUPPORTED_APIS:
-        error = ErrorResponse(
-            "INVALID_API",
-            f"Invalid API source '{api}'. Use danbooru, gelbooru, or safebooru.",
-        )
-        emit_error(error)
-        sys.exit(1)
+    for api in apis:
+        if api not in SUPPORTED_APIS:
+            raise RequestError(
+                "INVALID_API",
+                f"Invalid API source '{api}'. Use danbooru, gelbooru, or safebooru.",
+            )
 
+    if request.get("related"):
+        # Answered from posts already seen, no provider or credentials needed
+        if len(apis) > 1:
+            raise RequestError("INVALID_ARGS", "--related needs a single --api.")
+        return [
+            name
+            for name, _ in get_cooccurrence_table(apis[0]).related(
+                request["tags"], request["limit"]
+            )
+        ]
+
+    if len(apis) > 1:
+        return handle_federated_request(request, apis, provider_factory, emit)
+
+    api = apis[0]
     if api in {"danbooru", "gelbooru"} and (not api_user or not api_key):
-        error = ErrorResponse(
+        raise RequestError(
             "MISSING_CREDENTIALS",
             "danbooru/gelbooru require both --api-user and --api-key.",
         )
-        emit_error(error)
-        sys.exit(1)
 
     try:
-        provider = get_provider(api, api_user, api_key)
+        provider = provider_factory(api, api_user, api_key)
         if not provider:
-            error = ErrorResponse(
+            raise RequestError(
                 "PROVIDER_ERROR",
                 f"Failed to initialize provider for API: {api}.",
             )
-            emit_error(error)
-            sys.exit(1)
 
-        if tag_query:
-            data = provider.fetch_tags(tag_query)
+        if request.get("tag"):
+            data = provider.fetch_tags(request["tag"])
+        elif request.get("random"):
+            data, left = draw_random(
+                provider,
+                request["tags"],
+                request["limit"],
+                request_max_size(request),
+            )
+            for post in data if emit else []:
+                emit(post)
+            if left < RANDOM_POOL_LOW_WATER:
+                prefetcher(provider, request)
+        elif request.get("ids"):
+            found = provider.fetch_posts_by_ids(
+                request["ids"], request_max_size(request)
+            )
+            data = {
+                "posts": {str(i): found[i] for i in request["ids"] if i in found},
+                "missing": [i for i in request["ids"] if i not in found],
+            }
         else:
-            data = provider.fetch_posts(tags, post_id, page, limit)
+            if request["post_id"] == "random":
+                set_browsing_token(browsing_token(api, request["tags"]))
+            if request.get("fill") and request["post_id"] == "random":
+                data = fetch_filled(
+                    provider,
+                    request["tags"],
+                    request["page"],
+                    request["limit"],
+                    on_post=emit,
+                    max_size=request_max_size(request),
+                )
+            else:
+                data = []
+                for post in provider.iter_posts(
+                    request["tags"],
+                    request["post_id"],
+                    request["page"],
+                    request["limit"],
+                    request_max_size(request),
+                ):
+                    data.append(post)
+                    if emit:
+                        emit(post)
+            if data and request["post_id"] == "random" and request.get("prefetch"):
+                prefetcher(provider, request)
+    except RequestError:
+        raise
+    except Exception as e:
+        raise RequestError("UNEXPECTED_ERROR", str(e))
+
+    if data is None or (isinstance(data, list) and len(data) == 0):
+        raise RequestError(
+            "NO_RESULTS",
+            "No results found. Try different tags or verify the post exists.",
+        )
+
+    return data
+
+
+def streams_posts(request: Dict[str, Any]) -> bool:
+    """Whether the request lists posts, the only kind --stream applies to."""
+    return bool(request["stream"]) and not any(
+        request.get(key)
+        for key in ("action", "download", "tag", "related", "ids", "serve")
+    )
+
+
+def stream_summary(request: Dict[str, Any], posts: List[Dict[str, Any]]) -> Dict:
+    """Closing line of a streamed listing, carrying what paging needs."""
+    return {
+        "summary": {
+            "count": len(posts),
+            "page": request["page"],
+            "next_page": request["page"] + 1,
+            "limit": request["limit"],
+        }
+    }
+
+
+# ============================================================
+# Service mode
+# ============================================================
+
+
+SERVICE_SOCKET_PATH = (
+    Path(os.environ.get("XDG_RUNTIME_DIR") or Path.home() / ".config" / "ags" / "cache")
+    / "ags-booru.sock"
+)
+
 
-        if data is None or (isinstance(data, list) and len(data) == 0):
+BOOKMARK_COMPACT_INTERVAL = 60
+
+
+def coerce_request(raw: Dict[str, Any]) -> Dict[str, Any]:
+    """Validate a JSON service request and fill in CLI defaults."""
+    request = default_request()
+
+    for key in (
+        "api",
+        "post_id",
+        "tag",
+        "api_user",
+        "api_key",
+        "action",
+        "download",
+        "md5",
+        "output",
+    ):
+        value = raw.get(key)
+        if value is not None:
+            request[key] = str(value)
+
+    if request["api"]:
+        request["api"] = request["api"].lower()
+    if request["action"]:
+        request["action"] = request["action"].strip().lower()
+
+    tags = raw.get("tags")
+    if isinstance(tags, str):
+        request["tags"] = tags.split(",") if tags else []
+    elif isinstance(tags, list):
+        request["tags"] = [str(t) for t in tags]
+    elif tags is not None:
+        raise RequestError("INVALID_ARGS", "tags must be a list or a comma string.")
+
+    try:
+        for key in ("page", "limit", "prefetch", "max_width", "max_height"):
+            if raw.get(key) is not None:
+                request[key] = int(raw[key])
+    except (TypeError, ValueError) as e:
+        raise RequestError("INVALID_ARGS", f"Invalid argument format: {str(e)}")
+
+    request["fill"] = bool(raw.get("fill"))
+    request["stream"] = bool(raw.get("stream"))
+    request["random"] = bool(raw.get("random"))
+    request["related"] = bool(raw.get("related"))
+
+    ids = raw.get("ids")
+    if ids is not None:
+        try:
+            if isinstance(ids, str):
+                ids = [i for i in ids.split(",") if i.strip()]
+            request["ids"] = [int(i) for i in ids]
+        except (TypeError, ValueError) as e:
+            raise RequestError("INVALID_ARGS", f"Invalid argument format: {str(e)}")
+
+    credentials = raw.get("credentials")
+    if credentials is not None:
+        if not isinstance(credentials, dict):
+            raise RequestError("INVALID_ARGS", "credentials must be an object.")
+        request["credentials"] = credentials
+
+    if raw.get("timeout") is not None:
+        try:
+            request["timeout"] = float(raw["timeout"])
+        except (TypeError, ValueError) as e:
+            raise RequestError("INVALID_ARGS", f"Invalid argument format: {str(e)}")
+
+    payload = raw.get("payload")
+    if payload is not None:
+        if not isinstance(payload, dict):
+            raise RequestError("INVALID_PAYLOAD", "Payload JSON must be an object.")
+        request["payload"] = payload
+
+    return request
+
+
+class BooruService:
+    """
+    Long-lived request handler.
+    Providers (and their HTTP connections) are created once per
+    api/credentials pair and reused for every following request.
+    """
+
+    def __init__(self):
+        self._providers: Dict[
+            Tuple[str, Optional[str], Optional[str]], BooruProvider
+        ] = {}
+        self._providers_lock = threading.Lock()
+        # Bookmark actions read-modify-write the bookmark store, keep them serialized.
+        self._bookmarks_lock = threading.Lock()
+        # A single worker: a newer prefetch for the same tags queues behind the
+        # current one, and a tag change makes queued ones return immediately.
+        self._prefetch_pool = ThreadPoolExecutor(max_workers=1)
+        threading.Thread(target=self._compact_bookmarks_loop, daemon=True).start()
+
+    def prefetch(self, provider: BooruProvider, request: Dict[str, Any]) -> None:
+        self._prefetch_pool.submit(prefetch_pages, provider, prefetch_job(request))
+
+    def _compact_bookmarks_loop(self) -> None:
+        """Fold the bookmark journal into its snapshot while the service is idle."""
+        while True:
+            time.sleep(BOOKMARK_COMPACT_INTERVAL)
+            with self._bookmarks_lock:
+                try:
+                    store = get_bookmark_store()
+                    if store.pending_ops:
+                        store.compact()
+                except Exception as e:
+                    emit_error(ErrorResponse("BOOKMARK_ACTION_FAILED", str(e)))
+
+    def provider(
+        self, api: str, api_user: Optional[str] = None, api_key: Optional[str] = None
+    ) -> Optional[BooruProvider]:
+        key = (api, api_user, api_key)
+        with self._providers_lock:
+            provider = self._providers.get(key)
+            if provider is None:
+                provider = get_provider(api, api_user, api_key)
+                if provider:
+                    self._providers[key] = provider
+            return provider
+
+    def handle(
+        self, raw: Any, write: Optional[Callable[[str], None]] = None
+    ) -> Dict[str, Any]:
+        """
+        Handle one decoded request and wrap the result in a response envelope.
+        Streamed listings send {"id", "post"} lines through `write` first and
+        end with the stream summary as data.
+        """
+        request_id = raw.get("id") if isinstance(raw, dict) else None
+        try:
+            if not isinstance(raw, dict):
+                raise RequestError("INVALID_PAYLOAD", "Request must be a JSON object.")
+            request = coerce_request(raw)
+            emit = None
+            if write and streams_posts(request):
+                emit = lambda post: write(json.dumps({"id": request_id, "post": post}))
+            if request["action"]:
+                with self._bookmarks_lock:
+                    data = handle_request(request, self.provider, self.prefetch)
+            else:
+                data = handle_request(request, self.provider, self.prefetch, emit)
+            if emit and isinstance(data, list):
+                data = stream_summary(request, data)
+            return {"id": request_id, "data": data}
+        except RequestError as e:
+            return {"id": request_id, **e.error.to_dict()}
+        except Exception as e:
+            error = ErrorResponse("UNEXPECTED_ERROR", str(e))
+            return {"id": request_id, **error.to_dict()}
+
+    def handle_line(
+        self, line: str, write: Optional[Callable[[str], None]] = None
+    ) -> Optional[str]:
+        """Handle one NDJSON request line, returning the response line."""
+        if not line.strip():
+            return None
+        try:
+            raw = json.loads(line)
+        except json.JSONDecodeError as exc:
             error = ErrorResponse(
-                "NO_RESULTS",
-                "No results found. Try different tags or verify the post exists.",
+                "INVALID_PAYLOAD", f"Invalid request JSON: {str(exc)}"
             )
-            emit_error(error)
-            sys.exit(1)
+            return json.dumps({"id": None, **error.to_dict()})
+        return json.dumps(self.handle(raw, write))
 
-        print(json.dumps(data))
-    except Exception as e:
-        error = ErrorResponse("UNEXPECTED_ERROR", str(e))
+
+def serve_stdio(service: BooruService) -> None:
+    """Serve NDJSON requests from stdin, one response line per request on stdout."""
+
+    def write(response: str) -> None:
+        sys.stdout.write(response + "\n")
+        sys.stdout.flush()
+
+    for line in sys.stdin:
+        response = service.handle_line(line, write)
+        if response is not None:
+            write(response)
+
+
+def serve_socket(service: BooruService, socket_path: Path) -> None:
+    """Serve NDJSON requests over a Unix socket, one thread per connection."""
+
+    class Handler(socketserver.StreamRequestHandler):
+        def write(self, response: str) -> None:
+            self.wfile.write((response + "\n").encode("utf-8"))
+            self.wfile.flush()
+
+        def handle(self):
+            for raw_line in self.rfile:
+                line = raw_line.decode("utf-8", "replace")
+                response = service.handle_line(line, self.write)
+                if response is not None:
+                    self.write(response)
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    socket_path.parent.mkdir(parents=True, exist_ok=True)
+    if socket_path.exists():
+        socket_path.unlink()
+
+    with Server(str(socket_path), Handler) as server:
+        os.chmod(socket_path, 0o600)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if socket_path.exists():
+                socket_path.unlink()
+
+
+# ============================================================
+# CLI
+# ============================================================
+
+
+def parse_args(argv: List[str]) -> Dict[str, Any]:
+    request = default_request()
+    payload_json = None
+
+    try:
+        for i in range(1, len(argv)):
+            if argv[i] == "--api":
+                request["api"] = argv[i + 1].lower()
+            elif argv[i] == "--id":
+                request["post_id"] = argv[i + 1]
+            elif argv[i] == "--ids":
+                request["ids"] = [
+                    int(part) for part in argv[i + 1].split(",") if part.strip()
+                ]
+            elif argv[i] == "--tags":
+                request["tags"] = argv[i + 1].split(",")
+            elif argv[i] == "--tag":
+                request["tag"] = argv[i + 1]
+            elif argv[i] == "--page":
+                request["page"] = int(argv[i + 1])
+            elif argv[i] == "--limit":
+                request["limit"] = int(argv[i + 1])
+            elif argv[i] == "--api-user":
+                request["api_user"] = argv[i + 1]
+            elif argv[i] == "--api-key":
+                request["api_key"] = argv[i + 1]
+            elif argv[i] == "--action":
+                request["action"] = argv[i + 1].strip().lower()
+            elif argv[i] == "--payload-json":
+                payload_json = argv[i + 1]
+            elif argv[i] == "--credentials-json":
+                request["credentials"] = json.loads(argv[i + 1])
+            elif argv[i] == "--timeout":
+                request["timeout"] = float(argv[i + 1])
+            elif argv[i] == "--fill":
+                request["fill"] = True
+            elif argv[i] == "--stream":
+                request["stream"] = True
+            elif argv[i] == "--random":
+                request["random"] = True
+            elif argv[i] == "--related":
+                request["related"] = True
+            elif argv[i] == "--max-width":
+                request["max_width"] = int(argv[i + 1])
+            elif argv[i] == "--max-height":
+                request["max_height"] = int(argv[i + 1])
+            elif argv[i] == "--download":
+                request["download"] = argv[i + 1]
+            elif argv[i] == "--md5":
+                request["md5"] = argv[i + 1]
+            elif argv[i] == "--output":
+                request["output"] = argv[i + 1]
+            elif argv[i] == "--perceptual":
+                request["perceptual"] = True
+            elif argv[i] == "--prefetch":
+                request["prefetch"] = int(argv[i + 1])
+            elif argv[i] == "--prefetch-job":
+                request["prefetch_job"] = True
+            elif argv[i] == "--no-cache":
+                request["no_cache"] = True
+            elif argv[i] == "--pool-size":
+                request["pool_size"] = int(argv[i + 1])
+            elif argv[i] == "--serve":
+                request["serve"] = True
+            elif argv[i] == "--socket":
+                value = argv[i + 1] if i + 1 < len(argv) else ""
+                request["socket"] = (
+                    value
+                    if value and not value.startswith("--")
+                    else str(SERVICE_SOCKET_PATH)
+                )
+    except (IndexError, ValueError) as e:
+        raise RequestError("INVALID_ARGS", f"Invalid argument format: {str(e)}")
+
+    if not isinstance(request.get("credentials", {}), dict):
+        raise RequestError("INVALID_ARGS", "--credentials-json must be an object.")
+
+    if request["action"] and payload_json:
+        try:
+            parsed_payload = json.loads(payload_json)
+        except json.JSONDecodeError as exc:
+            raise RequestError("INVALID_PAYLOAD", f"Invalid payload JSON: {str(exc)}")
+
+        if not isinstance(parsed_payload, dict):
+            raise RequestError("INVALID_PAYLOAD", "Payload JSON must be an object.")
+        request["payload"] = parsed_payload
+
+    return request
+
+
+def main():
+    if len(sys.argv) < 2:
+        error = ErrorResponse(
+            "MISSING_ARGS",
+            "Missing required arguments. Use --api [danbooru|gelbooru|safebooru] and optional --id/--tags/--tag/--page/--limit/--api-user/--api-key, or --serve [--socket PATH].",
+        )
         emit_error(error)
         sys.exit(1)
 
+    try:
+        request = parse_args(sys.argv)
+    except RequestError as e:
+        emit_error(e.error)
+        sys.exit(1)
+
+    if request.get("no_cache"):
+        set_response_cache_enabled(False)
+
+    if request.get("pool_size"):
+        set_pool_size(request["pool_size"])
+
+    if request.get("perceptual"):
+        set_perceptual_hashing(True)
+
+    if request.get("prefetch_job"):
+        try:
+            run_prefetch_job(json.loads(sys.stdin.read()))
+        except Exception as e:
+            emit_error(ErrorResponse("PREFETCH_FAILED", str(e)))
+            sys.exit(1)
+        return
+
+    if request.get("serve"):
+        service = BooruService()
+        if request.get("socket"):
+            serve_socket(service, Path(request["socket"]).expanduser())
+        else:
+            serve_stdio(service)
+        return
+
+    emit = None
+    if streams_posts(request):
+        # NDJSON: one post per line as soon as it is parsed, then a summary line
+        emit = lambda post: print(json.dumps(post), flush=True)
+
+    try:
+        data = handle_request(request, emit=emit)
+    except RequestError as e:
+        emit_error(e.error)
+        sys.exit(1)
+
+    if emit and isinstance(data, list):
+        data = stream_summary(request, data)
+    print(json.dumps(data))
+
 
 if __name__ == "__main__":
     main()
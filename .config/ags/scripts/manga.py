@@ -12,6 +12,7 @@ Optimized for:
 from __future__ import annotations
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import asdict, dataclass
 import hashlib
 import json
@@ -154,6 +155,10 @@ class MangaDexProvider(MangaProvider):
     COVERS_DIR = Path.home() / ".config" / "ags" / "cache" / "manga" / name / "covers"
     PAGES_DIR = Path.home() / ".config" / "ags" / "cache" / "manga" / name / "pages"
 
+    # Covers fetched in parallel per listing; stays below the session's
+    # default connection pool size (10) so workers never wait on a socket.
+    COVER_WORKERS = 8
+
     def __init__(self, covers_dir: Optional[str] = None):
         """Initialize the MangaDex provider sessions and directories."""
         self.session = requests.Session()
@@ -275,6 +280,21 @@ class MangaDexProvider(MangaProvider):
             cover_width=cover_width,
         )
 
+    def _parse_many(
+        self, items: List[Dict[str, Any]], download_cover: bool = True
+    ) -> List[Manga]:
+        """Parse a listing, fetching missing covers concurrently in original order."""
+        if len(items) < 2:
+            return [self._parse(m, download_cover=download_cover) for m in items]
+
+        workers = min(self.COVER_WORKERS, len(items))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(
+                executor.map(
+                    lambda m: self._parse(m, download_cover=download_cover), items
+                )
+            )
+
     def search(
         self, query: str, limit: int, offset: int, download_covers: bool = True
     ) -> List[Manga]:
@@ -288,10 +308,7 @@ class MangaDexProvider(MangaProvider):
                 "includes[]": "cover_art",
             },
         )
-        return [
-            self._parse(m, include_cover=True, download_cover=download_covers)
-            for m in data["data"]
-        ]
+        return self._parse_many(data["data"], download_cover=download_covers)
 
     def popular(
         self, limit: int, offset: int, download_covers: bool = True
@@ -306,10 +323,7 @@ class MangaDexProvider(MangaProvider):
                 "includes[]": "cover_art",
             },
         )
-        return [
-            self._parse(m, include_cover=True, download_cover=download_covers)
-            for m in data["data"]
-        ]
+        return self._parse_many(data["data"], download_cover=download_covers)
 
     def get_by_id(self, provider_id: str, download_cover: bool = True) -> Manga:
         """Fetch single manga details by ID."""
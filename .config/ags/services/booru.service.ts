@@ -0,0 +1,113 @@
+import Gio from "gi://Gio";
+import GLib from "gi://GLib";
+
+const SCRIPT = `${GLib.get_home_dir()}/.config/ags/scripts/booru.py`;
+const SOCKET = `${
+  GLib.getenv("XDG_RUNTIME_DIR") || `${GLib.get_home_dir()}/.config/ags/cache`
+}/ags-booru.sock`;
+const START_TIMEOUT_MS = 5000;
+
+/** The service could not be reached or started; callers may run the CLI. */
+export class BooruServiceUnavailable extends Error {}
+
+let nextId = 0;
+let starting: Promise<void> | null = null;
+
+function connect(): Promise<Gio.SocketConnection> {
+  return new Promise((resolve, reject) => {
+    new Gio.SocketClient().connect_async(
+      Gio.UnixSocketAddress.new(SOCKET),
+      null,
+      (client, res) => {
+        try {
+          resolve(client!.connect_finish(res));
+        } catch (err) {
+          reject(err);
+        }
+      },
+    );
+  });
+}
+
+const sleep = (ms: number) =>
+  new Promise<void>((resolve) =>
+    GLib.timeout_add(GLib.PRIORITY_DEFAULT, ms, () => {
+      resolve();
+      return GLib.SOURCE_REMOVE;
+    }),
+  );
+
+/** Start `booru.py --serve` on the socket and wait until it accepts. */
+function startService(): Promise<void> {
+  starting ??= (async () => {
+    Gio.Subprocess.new(
+      ["python", SCRIPT, "--serve", "--socket", SOCKET],
+      Gio.SubprocessFlags.STDOUT_SILENCE | Gio.SubprocessFlags.STDERR_SILENCE,
+    );
+    for (let waited = 0; waited < START_TIMEOUT_MS; waited += 100) {
+      await sleep(100);
+      try {
+        (await connect()).close(null);
+        return;
+      } catch {
+        continue;
+      }
+    }
+    throw new BooruServiceUnavailable("booru.py service did not start");
+  })().finally(() => {
+    starting = null;
+  });
+  return starting;
+}
+
+/**
+ * Send one request to the long-lived booru.py service (started on first
+ * use) and resolve with its data, so callers skip a Python start per call.
+ */
+export async function booruRequest<T = any>(
+  request: Record<string, unknown>,
+): Promise<T> {
+  let connection: Gio.SocketConnection;
+  try {
+    connection = await connect();
+  } catch {
+    await startService();
+    connection = await connect().catch((err) => {
+      throw new BooruServiceUnavailable(String(err));
+    });
+  }
+
+  const id = ++nextId;
+  try {
+    const line = JSON.stringify({ ...request, id }) + "\n";
+    connection
+      .get_output_stream()
+      .write_all(new TextEncoder().encode(line), null);
+
+    const input = new Gio.DataInputStream({
+      base_stream: connection.get_input_stream(),
+    });
+    while (true) {
+      const raw = await new Promise<string | null>((resolve, reject) =>
+        input.read_line_async(GLib.PRIORITY_DEFAULT, null, (_, res) => {
+          try {
+            resolve(input.read_line_finish_utf8(res)[0]);
+          } catch (err) {
+            reject(err);
+          }
+        }),
+      );
+      if (raw === null) {
+        throw new Error("booru.py service closed the connection");
+      }
+      const response = JSON.parse(raw);
+      if (response.id !== id || "post" in response) continue;
+      if (response.error) {
+        throw new Error(response.message || "booru.py request failed");
+      }
+      return response.data as T;
+    }
+  } finally {
+    connection.close(null);
+  }
+}
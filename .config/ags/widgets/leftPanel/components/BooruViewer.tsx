@@ -64,6 +64,114 @@ const parseBooruArrayResponse = <T,>(
   return parsed as T[];
 };
 
+type BooruPage<T> = {
+  total: number;
+  offset: number;
+  limit: number;
+  bookmarks: T[];
+};
+
+const parseBooruPageResponse = <T,>(
+  raw: string,
+  invalidFormatMessage: string,
+): BooruPage<T> => {
+  if (!raw?.trim()) {
+    throw new Error("Received empty response from booru script");
+  }
+
+  let parsed: unknown;
+  try {
+    parsed = parseJson(raw);
+  } catch {
+    throw new Error(`${invalidFormatMessage}: ${raw.trim()}`);
+  }
+
+  if (typeof parsed !== "object" || parsed === null) {
+    throw new Error(invalidFormatMessage);
+  }
+
+  if ((parsed as BooruErrorEnvelope).error === true) {
+    throw new Error(formatBooruError(parsed as BooruErrorEnvelope));
+  }
+
+  if (!Array.isArray((parsed as BooruPage<T>).bookmarks)) {
+    throw new Error(invalidFormatMessage);
+  }
+
+  return parsed as BooruPage<T>;
+};
+
+/**
+ * Run booru.py with --stream and hand each post to onPost as its line
+ * arrives, so work on the first posts starts before the page is complete.
+ * Rejects with booru.py's stderr (an error envelope) when it fails.
+ */
+const streamBooruPosts = (
+  args: string[],
+  onPost: (post: any) => void,
+): Promise<void> =>
+  new Promise((resolve, reject) => {
+    const proc = Gio.Subprocess.new(
+      [...args, "--stream"],
+      Gio.SubprocessFlags.STDOUT_PIPE | Gio.SubprocessFlags.STDERR_PIPE,
+    );
+    const stdout = new Gio.DataInputStream({
+      base_stream: proc.get_stdout_pipe()!,
+    });
+
+    const finish = () => {
+      proc.wait_async(null, (_, res) => {
+        try {
+          proc.wait_finish(res);
+          if (proc.get_successful()) {
+            resolve();
+            return;
+          }
+          const bytes = proc.get_stderr_pipe()!.read_bytes(65536, null);
+          const stderr = new TextDecoder().decode(bytes.toArray()).trim();
+          reject(new Error(stderr || "booru.py exited with an error"));
+        } catch (err) {
+          reject(err);
+        }
+      });
+    };
+
+    const readLine = () => {
+      stdout.read_line_async(GLib.PRIORITY_DEFAULT, null, (_, res) => {
+        let line: string | null;
+        try {
+          [line] = stdout.read_line_finish_utf8(res);
+        } catch (err) {
+          reject(err);
+          return;
+        }
+
+        if (line === null) {
+          finish();
+          return;
+        }
+
+        if (line.trim()) {
+          let parsed: any;
+          try {
+            parsed = parseJson(line);
+          } catch {
+            proc.force_exit();
+            reject(
+              new Error(`Invalid response from booru API: ${line.trim()}`),
+            );
+            return;
+          }
+          // The closing {"summary": ...} line only carries paging info
+          if (!("summary" in parsed)) onPost(parsed);
+        }
+        readLine();
+      });
+    };
+
+    readLine();
+  });
+
 const booruErrorMessageFromUnknown = (
   err: unknown,
   fallback: string,
@@ -123,10 +231,11 @@ const createBooruViewerInstance = () => {
 
   const calculateCacheSize = async () => {
     try {
+      // Previews of the current api plus the shared media store
       const res = await execAsync(
-        `bash -c "du -sb ${booruPath}/${
+        `bash -c "du -sbc ${booruPath}/${
           globalSettings.peek().booru.api.value
-        }/previews | cut -f1"`,
+        }/previews ${booruPath}/media 2>/dev/null | tail -n1 | cut -f1"`,
       );
       // Convert bytes to megabytes
       setCacheSize(`${Math.round(Number(res) / (1024 * 1024))}mb`);
@@ -168,6 +277,8 @@ const createBooruViewerInstance = () => {
           globalSettings.peek().booru.api.value
         }/images/*"`,
       ),
+      // images/* are only links into the media store, which holds the bytes
+      execAsync(`bash -c "rm -rf ${booruPath}/media"`),
     ];
 
     Promise.all(promises)
@@ -184,9 +295,33 @@ const createBooruViewerInstance = () => {
         });
       });
   };
+  const downloadPreview = async (img: BooruImage) => {
+    const previewDir = `${booruPath}/${img.api.value}/previews`;
+    const filePath = `${previewDir}/${img.id}.${img.extension}`;
+
+    await execAsync(`mkdir -p "${previewDir}"`);
+
+    try {
+      await execAsync(`test -f "${filePath}"`);
+    } catch {
+      const userAgent = "AGSBooruViewer/1.0 (ArchLinux; Hyprland)";
+      const referer = img.api.url;
+
+      await execAsync(
+        `curl -sSf ` +
+          `-H "User-Agent: ${userAgent}" ` +
+          `-H "Referer: ${referer}" ` +
+          `-H "Accept: image/avif,image/webp,image/png,image/svg+xml,image/*;q=0.8" ` +
+          `-o "${filePath}" "${img.preview}"`,
+      );
+    }
+  };
+
   const fetchImages = async () => {
     try {
       setProgressStatus("loading");
+      // Bookmark membership for the cards, kept fresh against other writers
+      const bookmarksLoaded = BooruImage.hydrateBookmarkCache(true);
 
       const settings = globalSettings.peek();
       const limit = settings.booru.limit;
@@ -194,28 +329,23 @@ const createBooruViewerInstance = () => {
       const startIndex = limit > 0 ? (currentPage - 1) * limit : 0;
 
       let imagesToDisplay: BooruImage[] = [];
+      let previewDownloads: Promise<void>[] | null = null;
 
       // Determine source: bookmarks, pins, or API
       if (selectedTab.peek() === "Bookmarks") {
-        // Fetch bookmarks from backend
+        // Fetch the current page of bookmarks from backend
         const response = await execAsync([
           "python",
           booruScriptPath,
           "--action",
           "list-bookmarks",
+          "--payload-json",
+          JSON.stringify({ offset: startIndex, limit }),
         ]);
-        const bookmarks = parseBooruArrayResponse<any>(
+        const pagedBookmarks = parseBooruPageResponse<any>(
           response,
           "Invalid response format from bookmark list",
-        );
-        BooruImage.syncBookmarkCache(bookmarks);
-        setGlobalSetting("booru.bookmarks", bookmarks);
-
-        // Apply pagination
-        const pagedBookmarks =
-          limit > 0
-            ? bookmarks.slice(startIndex, startIndex + limit)
-            : bookmarks;
+        ).bookmarks;
         imagesToDisplay = pagedBookmarks.map(
           (b: BooruImage) => new BooruImage(b),
         );
@@ -245,6 +375,9 @@ const createBooruViewerInstance = () => {
           String(settings.booru.limit),
           "--page",
           String(settings.booru.page),
+          "--fill",
+          "--prefetch",
+          "1",
         ];
 
         if (credentials?.user.value && credentials?.key.value) {
@@ -256,46 +389,25 @@ const createBooruViewerInstance = () => {
           );
         }
 
-        const res = await execAsync(args);
-        const jsonData = parseBooruArrayResponse<any>(
-          res,
-          "Invalid response format from booru API",
-        );
-
-        imagesToDisplay = jsonData.map(
-          (img: any) =>
-            new BooruImage({
-              ...img,
-              api: settings.booru.api,
-            }),
-        );
+        // Start each preview download as soon as its post is streamed
+        const downloads: Promise<void>[] = [];
+        await streamBooruPosts(args, (post) => {
+          const img = new BooruImage({
+            ...post,
+            api: settings.booru.api,
+          });
+          imagesToDisplay.push(img);
+          downloads.push(downloadPreview(img));
+        });
+        previewDownloads = downloads;
       }
 
-      // Download all previews in parallel (unified for both sources)
+      // Download all previews in parallel (unified for all sources)
       await Promise.all(
-        imagesToDisplay.map(async (img) => {
-          const previewDir = `${booruPath}/${img.api.value}/previews`;
-          const filePath = `${previewDir}/${img.id}.${img.extension}`;
-
-          await execAsync(`mkdir -p "${previewDir}"`);
-
-          try {
-            await execAsync(`test -f "${filePath}"`);
-          } catch {
-            const userAgent = "AGSBooruViewer/1.0 (ArchLinux; Hyprland)";
-            const referer = img.api.url;
-
-            await execAsync(
-              `curl -sSf ` +
-                `-H "User-Agent: ${userAgent}" ` +
-                `-H "Referer: ${referer}" ` +
-                `-H "Accept: image/avif,image/webp,image/png,image/svg+xml,image/*;q=0.8" ` +
-                `-o "${filePath}" "${img.preview}"`,
-            );
-          }
-        }),
+        previewDownloads ?? imagesToDisplay.map(downloadPreview),
       );
 
+      await bookmarksLoaded;
       setImages(imagesToDisplay);
       calculateCacheSize();
       setProgressStatus("success");
@@ -22,6 +22,7 @@ import {
   updateUserProfile,
 } from "../../../utils/user-profile";
 import { setProfileAvatarFromPath } from "../../../utils/profile-avatar";
+import { BooruImage, bookmarkKeys } from "../../../class/BooruImage.class";
 
 function UserProfile({ minimal = false }: { minimal?: boolean }) {
   const supabaseClient = new Supabase();
@@ -95,13 +96,14 @@ function UserProfile({ minimal = false }: { minimal?: boolean }) {
     return `${localPart[0]}***@${domain}`;
   });
 
-  const booruFavoriteCounts = globalSettings(({ booru }) => {
+  void BooruImage.hydrateBookmarkCache(true);
+  const booruFavoriteCounts = bookmarkKeys((keys) => {
     const counts: Record<string, number> = Object.fromEntries(
       booruApis.map((api) => [api.value, 0]),
     );
 
-    for (const bookmark of booru.bookmarks ?? []) {
-      const apiValue = bookmark?.api?.value;
+    for (const key of keys) {
+      const apiValue = key.slice(key.indexOf(":") + 1);
       if (apiValue && typeof counts[apiValue] === "number") {
         counts[apiValue] += 1;
       }